@@ -0,0 +1,262 @@
+"""
+Benchmarks for utils.database, run against a throwaway activity.db with synthetic
+guilds. Nothing here talks to Discord.
+
+    python benchmarks/bench_database.py --members 1000,10000,100000 --upserts 200000
+    python benchmarks/bench_database.py --output before.json
+
+Results are written as JSON so runs from different versions can be diffed. Each
+guild size gets its own guild in the same database, so the larger sizes also show
+how the smaller guilds' queries hold up as the tables grow.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows per db_exec call when seeding a guild
+SEED_CHUNK = 5000
+
+# Seconds between queue depth samples during the saturation test
+SAMPLE_INTERVAL = 0.01
+
+
+def percentiles(samples):
+    """
+    :param samples: List of latencies in seconds
+    :return: A dict of the usual latency percentiles, in milliseconds
+    """
+    if not samples:
+        return {}
+
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "-C", ROOT, "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def db_size(path):
+    """
+    :return: Bytes taken up by the database, including whatever hasn't been
+        checkpointed out of the write-ahead log yet
+    """
+    wal = path + "-wal"
+    return os.path.getsize(path) + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+
+async def timed(samples, call):
+    start = perf_counter()
+    result = await call
+    samples.append(perf_counter() - start)
+    return result
+
+
+async def seed_guild(db, guild_id, members, now):
+    """
+    Gives every member of a synthetic guild a last message somewhere in the last 60 days.
+    :return: Seconds taken
+    """
+    start = perf_counter()
+    day_ms = 24 * 60 * 60 * 1000
+    for first in range(0, members, SEED_CHUNK):
+        rows = [
+            (guild_id, user_id, f"user{user_id}", now - random.randrange(60 * day_ms), 1)
+            for user_id in range(first, min(members, first + SEED_CHUNK))
+        ]
+        await db.db_exec(db.add_timestamps, rows, lane=db.LANE_BACKFILL)
+    return perf_counter() - start
+
+
+async def bench_upserts(db, guild_id, members, upserts, in_flight, now):
+    """
+    Sends single-row add_timestamp calls through db_exec, with up to in_flight of them
+    waiting at once, like a burst of on_message events.
+    """
+    latencies = []
+    semaphore = asyncio.Semaphore(in_flight)
+
+    async def upsert(i):
+        async with semaphore:
+            user_id = random.randrange(members)
+            await timed(latencies, db.db_exec(
+                db.add_timestamp, guild_id, user_id, f"user{user_id}", now + i, lane=db.LANE_LIVE
+            ))
+
+    start = perf_counter()
+    await asyncio.gather(*(upsert(i) for i in range(upserts)))
+    elapsed = perf_counter() - start
+
+    return {
+        "upserts": upserts,
+        "in_flight": in_flight,
+        "seconds": round(elapsed, 3),
+        "per_second": round(upserts / elapsed, 1),
+        "latency": percentiles(latencies),
+    }
+
+
+async def bench_reads(db, guild_id, repeat):
+    last_active_times = []
+    limits = []
+    for _ in range(repeat):
+        await timed(last_active_times, db.db_read(db.get_last_active_times, guild_id))
+        await timed(limits, db.db_read(db.get_limit, guild_id))
+
+    return {
+        "get_last_active_times": percentiles(last_active_times),
+        "get_limit": percentiles(limits),
+    }
+
+
+async def bench_saturation(db, guild_id, members, burst, now):
+    """
+    Queues a burst of writes all at once, then watches the queue drain while timing
+    interactive reads, which shouldn't have to wait for the writes.
+    """
+    depths = []
+    read_latencies = []
+
+    writes = [
+        db.db_exec(db.add_timestamp, guild_id, user_id % members, f"user{user_id}", now + user_id, lane=db.LANE_LIVE)
+        for user_id in range(burst)
+    ]
+
+    start = perf_counter()
+    pending = asyncio.ensure_future(asyncio.gather(*writes))
+
+    while not pending.done():
+        depths.append(sum(db.db_queue_depths()["write"].values()))
+        await timed(read_latencies, db.db_read(db.get_limit, guild_id))
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+    await pending
+    drained = perf_counter() - start
+
+    return {
+        "burst": burst,
+        "drain_seconds": round(drained, 3),
+        "per_second": round(burst / drained, 1),
+        "peak_write_queue": max(depths, default=0),
+        "read_latency_during_burst": percentiles(read_latencies),
+    }
+
+
+async def run(db, args):
+    now = int(time.time() * 1000)
+    results = []
+
+    for guild_id, members in enumerate(args.members, start=1):
+        print(f"Guild {guild_id}: {members} members", file=sys.stderr)
+        result = {"guild_id": guild_id, "members": members}
+
+        result["seed_seconds"] = round(await seed_guild(db, guild_id, members, now), 3)
+        result["upserts"] = await bench_upserts(db, guild_id, members, args.upserts, args.in_flight, now)
+        result["reads"] = await bench_reads(db, guild_id, args.read_repeat)
+        result["saturation"] = await bench_saturation(db, guild_id, members, args.burst, now + args.upserts)
+        result["db_bytes"] = db_size(db.DB_PATH)
+
+        results.append(result)
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", default="1000,10000,100000",
+                        type=lambda value: [int(n) for n in value.split(",")],
+                        help="Comma separated guild sizes to test (default: %(default)s)")
+    parser.add_argument("--upserts", type=int, default=100000,
+                        help="add_timestamp calls per guild (default: %(default)s)")
+    parser.add_argument("--in-flight", type=int, default=1000,
+                        help="Upserts waiting on the database at once (default: %(default)s)")
+    parser.add_argument("--read-repeat", type=int, default=50,
+                        help="Times each read is repeated per guild (default: %(default)s)")
+    parser.add_argument("--burst", type=int, default=50000,
+                        help="Writes queued at once in the saturation test (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: %(default)s)")
+    parser.add_argument("--output", help="File to write the JSON results to, instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary database afterwards")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # utils.database opens activity.db in the working directory as soon as it's
+    # imported, so move somewhere disposable first.
+    workdir = tempfile.mkdtemp(prefix="adiosbot-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import utils.database as db
+
+    try:
+        results = asyncio.run(run(db, args))
+    finally:
+        db.db_close()
+        while not db.is_db_stopped():
+            time.sleep(0.1)
+
+        if args.keep:
+            print(f"Database kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "batch_size": db.DEFAULT_BATCH_SIZE,
+        "batch_window": db.DEFAULT_BATCH_WINDOW,
+        "readers": db.DEFAULT_READERS,
+        "parameters": {
+            "upserts": args.upserts,
+            "in_flight": args.in_flight,
+            "read_repeat": args.read_repeat,
+            "burst": args.burst,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
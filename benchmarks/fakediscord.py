@@ -0,0 +1,256 @@
+"""
+Stand-ins for the parts of discord.py the bot uses, backed by synthetic data, for
+load testing without a connection to Discord. Only the attributes and methods the
+bot actually touches are implemented.
+
+Latency and rate limiting are simulated with a Network, shared by everything in a
+FakeGuild, so a run can be made as slow and as flaky as a real guild.
+"""
+import asyncio
+import random
+from datetime import datetime, timezone, timedelta
+
+import discord
+
+# Messages per channel.history request, as in discord.py
+HISTORY_PAGE_SIZE = 100
+
+
+class Network:
+    """
+    Simulated request latency and 429s.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_chance=0.0, retry_after=1.0):
+        """
+        :param latency: Seconds each request takes
+        :param jitter: Up to this many extra seconds added to each request at random
+        :param rate_limit_chance: Chance (0-1) of a request being answered with a 429
+        :param retry_after: Seconds a 429 asks the client to wait
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def request(self):
+        """
+        Waits as long as a request would take.
+        :return: The Retry-After of a 429 if the request was rate limited, otherwise None
+        """
+        self.requests += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.rate_limit_chance and random.random() < self.rate_limit_chance:
+            self.rate_limited += 1
+            return self.retry_after
+        return None
+
+
+class FakeMember:
+    def __init__(self, guild, user_id, name, bot=False):
+        self.guild = guild
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.guild_permissions = discord.Permissions.none()
+
+    def __repr__(self):
+        return f"<FakeMember id={self.id} name={self.name!r}>"
+
+    async def kick(self, reason=None):
+        # Like history, discord.py sleeps through 429s on kicks rather than raising
+        while (retry_after := await self.guild.network.request()) is not None:
+            await asyncio.sleep(retry_after)
+
+        self.guild.remove_member(self)
+        if self.guild.on_raw_member_remove is not None:
+            await self.guild.on_raw_member_remove(FakeRawMemberRemoveEvent(self.guild.id, self))
+
+
+class FakeRawMemberRemoveEvent:
+    def __init__(self, guild_id, user):
+        self.guild_id = guild_id
+        self.user = user
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, author, created_at):
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.created_at = created_at
+        self.content = ""
+
+
+class FakeTextChannel:
+    def __init__(self, guild, channel_id, name):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.messages = []
+        self.last_message_id = None
+
+    def permissions_for(self, member):
+        return discord.Permissions(view_channel=True, read_message_history=True)
+
+    def add_message(self, author, created_at):
+        """
+        Posts a message. Messages must be added oldest first.
+        :return: The new FakeMessage
+        """
+        message_id = discord.utils.time_snowflake(created_at)
+        if self.last_message_id is not None and message_id <= self.last_message_id:
+            message_id = self.last_message_id + 1
+
+        message = FakeMessage(message_id, self, author, created_at)
+        self.messages.append(message)
+        self.last_message_id = message_id
+        return message
+
+    async def history(self, limit=None, oldest_first=True, after=None):
+        if isinstance(after, datetime):
+            after_id = discord.utils.time_snowflake(after, high=True)
+        elif after is not None:
+            after_id = after.id
+        else:
+            after_id = 0
+
+        messages = [message for message in self.messages if message.id > after_id]
+        if not oldest_first:
+            messages.reverse()
+        if limit is not None:
+            messages = messages[:limit]
+
+        for start in range(0, len(messages), HISTORY_PAGE_SIZE):
+            # discord.py waits out 429s on history requests itself
+            while (retry_after := await self.guild.network.request()) is not None:
+                await asyncio.sleep(retry_after)
+
+            for message in messages[start:start + HISTORY_PAGE_SIZE]:
+                yield message
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name, network=None):
+        self.id = guild_id
+        self.name = name
+        self.network = network or Network()
+        self.chunked = True
+        self.text_channels = []
+        self._members = {}
+
+        self.me = FakeMember(self, guild_id, "AdiosBot", bot=True)
+        self.owner_id = None
+
+        # Coroutine function taking a raw member remove event, called when a member
+        # is kicked - the replay driver points this at the bot's handler.
+        self.on_raw_member_remove = None
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def member_count(self):
+        return len(self._members)
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    def add_member(self, member):
+        self._members[member.id] = member
+
+    def remove_member(self, member):
+        self._members.pop(member.id, None)
+
+    async def chunk(self, cache=True):
+        await self.network.request()
+        if cache:
+            self.chunked = True
+        return self.members
+
+
+def make_guild(guild_id, members, channels, messages, days=60, active=0.5, bots=0.01, network=None):
+    """
+    Builds a guild with a message history spread over the last few days.
+    :param guild_id: ID of the guild. Member and channel IDs are derived from it, so
+        guilds built with different IDs don't share any.
+    :param members: Number of members
+    :param channels: Number of text channels
+    :param messages: Number of messages in each channel
+    :param days: How many days back the history goes
+    :param active: Fraction of human members who have ever posted
+    :param bots: Fraction of members that are bots
+    :param network: Network to simulate requests with
+    """
+    guild = FakeGuild(guild_id, f"Guild {guild_id}", network)
+    base = guild_id * 10_000_000
+
+    for i in range(members):
+        user_id = base + i
+        guild.add_member(FakeMember(guild, user_id, f"user{user_id}", bot=random.random() < bots))
+
+    humans = [member for member in guild.members if not member.bot]
+    guild.owner_id = humans[0].id if humans else None
+    posters = random.sample(humans, max(1, int(len(humans) * active))) if humans else [guild.me]
+
+    now = datetime.now(timezone.utc)
+    for i in range(channels):
+        channel = FakeTextChannel(guild, base + members + i, f"channel-{i}")
+        times = sorted(now - timedelta(seconds=random.uniform(0, days * 86400)) for _ in range(messages))
+        for created_at in times:
+            channel.add_message(random.choice(posters), created_at)
+        guild.text_channels.append(channel)
+
+    return guild
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, ephemeral=False, **kwargs):
+        await self._interaction.guild.network.request()
+        self._done = True
+        self._interaction.messages.append(content)
+
+    async def defer(self, ephemeral=False, **kwargs):
+        await self._interaction.guild.network.request()
+        self._done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, ephemeral=False, **kwargs):
+        await self._interaction.guild.network.request()
+        self._interaction.messages.append(content)
+
+
+class FakeInteraction:
+    """
+    A slash command invocation. Everything the command sends back is kept in messages.
+    """
+    def __init__(self, guild, user, channel_id=None):
+        self.guild = guild
+        self.user = user
+        self.channel_id = channel_id
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.messages = []
+
+    async def edit_original_response(self, content=None, **kwargs):
+        await self.guild.network.request()
+        self.messages.append(content)
@@ -0,0 +1,345 @@
+"""
+Load test for the whole bot, against fake guilds instead of Discord. Builds
+synthetic guilds (see fakediscord.py), syncs them the way on_ready does, then
+replays a stream of message events and slash commands through the bot's own
+on_message handler and cog commands.
+
+    python benchmarks/replay.py --members 1000,20000 --channels 20 --messages 5000
+    python benchmarks/replay.py --latency 0.05 --rate-limit-chance 0.02 --kick 30
+    python benchmarks/replay.py --record events.jsonl
+    python benchmarks/replay.py --events events.jsonl --speed 1
+
+Event streams are JSON lines, one event each:
+
+    {"at": 0.25, "type": "message", "guild": 1, "channel": 10001000, "author": 10000042}
+    {"at": 1.5, "type": "command", "guild": 1, "name": "inactive", "n": 30}
+
+"at" is seconds from the start of the replay. Member and channel IDs come from
+fakediscord.make_guild, so a recorded stream replays against guilds built with the
+same --members, --channels and --seed. Commands are "inactive", "kick_inactive" and
+"kick_job_status".
+
+Reports sync time, event and command latency percentiles, simulated requests and
+peak memory as JSON. The bot runs in a temporary working directory with its own
+activity.db, so nothing here touches a real database.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import perf_counter
+
+from bench_database import percentiles, git_version
+from fakediscord import Network, FakeInteraction, make_guild
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_events(guilds, duration, rate, command_every, kick_days):
+    """
+    Generates a stream of messages from random members, with an /inactive every
+    command_every messages and optionally a /kick_inactive at the end.
+    """
+    humans = {guild.id: [member for member in guild.members if not member.bot] or [guild.me] for guild in guilds}
+    events = []
+    at = 0.0
+    count = 0
+    while at < duration:
+        guild = random.choice(guilds)
+        author = random.choice(humans[guild.id])
+        channel = random.choice(guild.text_channels)
+        events.append({"at": round(at, 4), "type": "message", "guild": guild.id, "channel": channel.id, "author": author.id})
+
+        count += 1
+        if command_every and count % command_every == 0:
+            events.append({"at": round(at, 4), "type": "command", "guild": guild.id, "name": "inactive", "n": 30})
+
+        at += random.expovariate(rate)
+
+    if kick_days is not None:
+        for guild in guilds:
+            events.append({"at": round(at, 4), "type": "command", "guild": guild.id, "name": "kick_inactive", "n": kick_days})
+            events.append({"at": round(at, 4), "type": "command", "guild": guild.id, "name": "kick_job_status"})
+
+    return events
+
+
+class Replay:
+    def __init__(self, bot_main, guilds, speed):
+        from cogs.activity import Activity
+        from cogs.moderation import Moderation
+
+        self.main = bot_main
+        self.guilds = {guild.id: guild for guild in guilds}
+        self.channels = {channel.id: channel for guild in guilds for channel in guild.text_channels}
+        self.speed = speed
+
+        # The cog starts rotating the bot's status straight away, which needs a
+        # logged in bot
+        self.activity = Activity(bot_main.bot)
+        self.activity.change_song.cancel()
+        self.moderation = Moderation(bot_main.bot)
+        self.commands = {
+            "inactive": lambda interaction, event: self.activity.check_inactive.callback(
+                self.activity, interaction, event.get("n", 30)),
+            "kick_inactive": lambda interaction, event: self.moderation.kick_inactive.callback(
+                self.moderation, interaction, event.get("n", 30)),
+            "kick_job_status": lambda interaction, event: self.moderation.kick_job_status.callback(
+                self.moderation, interaction, event.get("job_id")),
+        }
+
+        self.message_latencies = []
+        self.command_latencies = defaultdict(list)
+        self.skipped = 0
+
+    async def message(self, event):
+        channel = self.channels.get(event["channel"])
+        author = channel.guild.get_member(event["author"]) if channel is not None else None
+        if author is None:
+            # Kicked earlier in the replay
+            self.skipped += 1
+            return
+
+        message = channel.add_message(author, datetime.now(timezone.utc))
+
+        start = perf_counter()
+        await self.main.on_message(message)
+        self.message_latencies.append(perf_counter() - start)
+
+    async def command(self, event):
+        guild = self.guilds[event["guild"]]
+        owner = guild.get_member(guild.owner_id) or guild.me
+        interaction = FakeInteraction(guild, owner, guild.text_channels[0].id if guild.text_channels else None)
+
+        start = perf_counter()
+        await self.commands[event["name"]](interaction, event)
+        self.command_latencies[event["name"]].append(perf_counter() - start)
+
+    async def run(self, events):
+        """
+        Replays the events, each as its own task like discord.py dispatches them.
+        :return: Seconds taken
+        """
+        tasks = []
+        start = perf_counter()
+
+        for event in events:
+            if self.speed:
+                delay = event["at"] / self.speed - (perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            handler = self.message if event["type"] == "message" else self.command
+            tasks.append(asyncio.create_task(handler(event)))
+
+            # Let the handlers run between events even when replaying flat out
+            await asyncio.sleep(0)
+
+        await asyncio.gather(*tasks)
+        return perf_counter() - start
+
+
+async def run(bot_main, args):
+    from utils.functions import sync_guilds
+    from utils.metrics import CHANNEL_SYNC_DURATION, KICKS
+
+    network = Network(args.latency, args.jitter, args.rate_limit_chance, args.retry_after)
+    build_start = perf_counter()
+    guilds = [
+        make_guild(guild_id, members, args.channels, args.messages, args.days, network=network)
+        for guild_id, members in enumerate(args.members, start=1)
+    ]
+    for guild in guilds:
+        guild.on_raw_member_remove = bot_main.on_raw_member_remove
+        # As if chunk_guilds_at_startup were off
+        guild.chunked = not args.lazy_members
+    print(f"Built {len(guilds)} guilds in {perf_counter() - build_start:.2f}s", file=sys.stderr)
+
+    if args.events:
+        with open(args.events, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = synthetic_events(guilds, args.duration, args.rate, args.command_every, args.kick)
+
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(event) + "\n" for event in events)
+
+    replay = Replay(bot_main, guilds, args.speed)
+    bot_main.flush_activity_cache.start()
+    try:
+        sync_start = perf_counter()
+        await sync_guilds(guilds)
+        sync_seconds = perf_counter() - sync_start
+        sync_requests = network.requests
+        print(f"Synced in {sync_seconds:.2f}s, replaying {len(events)} events", file=sys.stderr)
+
+        replay_seconds = await replay.run(events)
+    finally:
+        bot_main.flush_activity_cache.cancel()
+        await bot_main.activity_cache.flush()
+
+    channel_syncs = CHANNEL_SYNC_DURATION.values.get(())
+    return {
+        "guilds": [
+            {"guild_id": guild.id, "members": len(guild.members), "channels": len(guild.text_channels)}
+            for guild in guilds
+        ],
+        "sync": {
+            "seconds": round(sync_seconds, 3),
+            "requests": sync_requests,
+            "channels_fetched": channel_syncs[2] if channel_syncs else 0,
+            "channel_p95_seconds": CHANNEL_SYNC_DURATION.quantile(0.95, ()),
+        },
+        "replay": {
+            "events": len(events),
+            "seconds": round(replay_seconds, 3),
+            "events_per_second": round(len(events) / replay_seconds, 1) if replay_seconds else None,
+            "skipped_messages": replay.skipped,
+            "on_message": percentiles(replay.message_latencies),
+            "commands": {name: percentiles(latencies) for name, latencies in replay.command_latencies.items()},
+        },
+        "network": {
+            "requests": network.requests,
+            "rate_limited": network.rate_limited,
+        },
+        "kicks": {
+            "kicked": KICKS.total(result="kicked"),
+            "failed": KICKS.total(result="failed"),
+        },
+    }
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", default="1000",
+                        type=lambda value: [int(n) for n in value.split(",")],
+                        help="Comma separated sizes of the guilds to build, one guild each (default: %(default)s)")
+    parser.add_argument("--channels", type=int, default=10, help="Text channels per guild (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="Messages of history per channel (default: %(default)s)")
+    parser.add_argument("--days", type=int, default=60, help="Days the history covers (default: %(default)s)")
+
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Extra random seconds per request, up to this much (default: %(default)s)")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.0,
+                        help="Chance of a request getting a 429 (default: %(default)s)")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="Seconds a 429 asks to wait (default: %(default)s)")
+
+    parser.add_argument("--events", help="JSON lines file of events to replay, instead of generating them")
+    parser.add_argument("--record", help="Write the events replayed to this file")
+    parser.add_argument("--duration", type=float, default=60.0,
+                        help="Seconds of synthetic events to generate (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=100.0,
+                        help="Synthetic messages per second (default: %(default)s)")
+    parser.add_argument("--command-every", type=int, default=500,
+                        help="Messages between synthetic /inactive commands, 0 for none (default: %(default)s)")
+    parser.add_argument("--kick", type=int, metavar="DAYS",
+                        help="End the synthetic stream with /kick_inactive DAYS in every guild")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="Replay speed - 1 is real time, 0 is as fast as possible (default: %(default)s)")
+
+    parser.add_argument("--lazy-members", action="store_true",
+                        help="Run with LAZY_MEMBERS, so member lists are downloaded on demand")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: %(default)s)")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Also report peak Python heap use. Slows everything down noticeably.")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own logging")
+    parser.add_argument("--output", help="File to write the JSON results to, instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    output = os.path.abspath(args.output) if args.output else None
+    for name in ("events", "record"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    # The bot keeps activity.db, bot.log and its whitelists in the working directory
+    workdir = tempfile.mkdtemp(prefix="adiosbot-replay-")
+    shutil.copy(os.path.join(ROOT, "goodbye_songs.json"), workdir)
+    os.chdir(workdir)
+    os.environ.setdefault("DISCORD_BOT_TOKEN", "replay")
+    os.environ["WORKING_DIR"] = workdir
+    os.environ["LAZY_MEMBERS"] = "1" if args.lazy_members else ""
+    sys.path.insert(0, ROOT)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    import main as bot_main
+    from utils.database import db_close, is_db_stopped
+
+    if not args.verbose:
+        for handler in logging.getLogger().handlers:
+            handler.setLevel(logging.WARNING)
+
+    # There are no prefix commands, and the bot never logs in to have a user
+    # to check messages against.
+    async def process_commands(message):
+        pass
+    bot_main.bot.process_commands = process_commands
+
+    try:
+        results = asyncio.run(run(bot_main, args))
+    finally:
+        db_close()
+        while not is_db_stopped():
+            time.sleep(0.1)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results["memory"] = {
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_traced_bytes": tracemalloc.get_traced_memory()[1] if args.tracemalloc else None,
+    }
+
+    report = {
+        "version": git_version(),
+        "parameters": {
+            "channels": args.channels,
+            "messages": args.messages,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "rate_limit_chance": args.rate_limit_chance,
+            "events": args.events,
+            "speed": args.speed,
+            "lazy_members": args.lazy_members,
+            "seed": args.seed,
+        },
+        **results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,9 @@ import discord
 from discord import app_commands, Interaction
 from discord.ext import commands, tasks
 
-from utils.database import db_exec, get_last_active_time
-from utils.functions import get_last_message_time, get_whitelist
+from utils.database import to_epoch_ms
+from utils.functions import get_inactive_members, get_whitelist, get_last_active, refresh_members, \
+    get_lurking_members, get_daily_active_counts
 from utils.globals import working_dir
 from utils.syncmanager import sync_manager
 
@@ -43,25 +44,19 @@ class Activity(commands.Cog):
         guild = interaction.guild
 
         await interaction.response.defer(ephemeral=True)
+        await refresh_members(guild)
 
-        user_last_message = await get_last_message_time(guild)
         inactive_members = []
         inactive_whitelisted_members = []
-        cutoff_date = datetime.now(timezone.utc) - timedelta(days=n)
+        cutoff_date = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=n))
 
-        whitelist = get_whitelist(guild)
+        whitelist = await get_whitelist(guild)
 
-        for member in guild.members:
-            if not (member.bot or member == guild.owner):
-                last_message_time = user_last_message.get(member.id)
-
-                logger.debug(f"{member.name} lm {last_message_time} co {cutoff_date}")
-
-                if last_message_time is None or last_message_time < cutoff_date:
-                    if member.id not in whitelist:
-                        inactive_members.append(member.name)
-                    else:
-                        inactive_whitelisted_members.append(member.name)
+        for member_id, member_name in await get_inactive_members(guild, cutoff_date):
+            if member_id not in whitelist:
+                inactive_members.append(member_name)
+            else:
+                inactive_whitelisted_members.append(member_name)
 
         inactive_members.sort()
         inactive_whitelisted_members.sort()
@@ -89,6 +84,69 @@ class Activity(commands.Cog):
 
         await interaction.followup.send(response_str)
 
+    @app_commands.command(name="lurkers", description="Checks which users were active on only a few of the last n days.")
+    @app_commands.describe(
+        n="Number of days to look back over",
+        k="Users who sent messages on fewer than this many of those days are lurkers"
+    )
+    async def check_lurkers(self, interaction: Interaction, n: int = 30, k: int = 3):
+        if not sync_manager.is_ready(interaction.guild.id):
+            await interaction.response.send_message("Message history is still syncing - please try again later.", ephemeral=True)
+            return
+
+        if n < 7:
+            await interaction.response.send_message("A week at least, please - lurking takes time. :eyes:", ephemeral=True)
+            return
+
+        if n > 60:
+            await interaction.response.send_message("I only remember the last 60 days - try a period less than or equal to 60 days. :thinking:", ephemeral=True)
+            return
+
+        if k < 1 or k > n:
+            await interaction.response.send_message(f"k needs to be between 1 and {n}.", ephemeral=True)
+            return
+
+        logger.debug(f"Command received /lurkers {n} {k}")
+        guild = interaction.guild
+
+        await interaction.response.defer(ephemeral=True)
+        await refresh_members(guild)
+
+        whitelist = await get_whitelist(guild)
+        lurkers = []
+        whitelisted_lurkers = 0
+
+        for member_id, member_name, active_days in await get_lurking_members(guild, n, k):
+            if member_id in whitelist:
+                whitelisted_lurkers += 1
+            else:
+                lurkers.append((member_name, active_days))
+
+        daily_active = await get_daily_active_counts(guild, n)
+
+        lurkers.sort()
+
+        response_str = f"Daily active users over the last {n} days: {sum(daily_active) / n:.1f} on average, {max(daily_active)} at most\n\n"
+
+        if lurkers:
+            lurker_count = len(lurkers)
+            response_str += f"**{lurker_count} members active on fewer than {k} of the last {n} days**\n\n"
+            for idx, (member, active_days) in enumerate(lurkers):
+                if idx >= 32:
+                    response_str += f"(+{lurker_count - 32} more)"
+                    break
+
+                response_str += f"{member} ({active_days} days)"
+                if idx != lurker_count - 1:
+                    response_str += "\n"
+        else:
+            response_str += f"No members active on fewer than {k} of the last {n} days."
+
+        if whitelisted_lurkers:
+            response_str += f"\n\n(Not including {whitelisted_lurkers} whitelisted members)"
+
+        await interaction.followup.send(response_str)
+
     @app_commands.command(name="last_message", description="Check when you were last active.")
     @app_commands.describe(user="User to check. Defaults to yourself. Only admins can check users other than themselves.")
     async def last_message(self, interaction: Interaction, user: discord.Member = None):
@@ -118,11 +176,7 @@ class Activity(commands.Cog):
             await interaction.response.send_message("Don't worry about the bots, they're spared from my wrath. :upside_down:", ephemeral=True)
             return
 
-        last_active_time = await db_exec(
-            get_last_active_time,
-            interaction.guild.id,
-            user.id
-        )
+        last_active_time = await get_last_active(interaction.guild.id, user.id)
 
         if last_active_time is None:
             message = \
@@ -133,7 +187,7 @@ class Activity(commands.Cog):
             await interaction.response.send_message(message, ephemeral=True)
             return
 
-        unix_timestamp = datetime.fromisoformat(last_active_time).timestamp()
+        unix_timestamp = last_active_time // 1000
 
         message = \
             f"Your last message was sent <t:{int(unix_timestamp)}:R>. Keep messaging if you don't want me kicking you. :wink:" \
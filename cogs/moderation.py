@@ -1,18 +1,43 @@
 import logging
 from datetime import datetime, timedelta, timezone
 
-import discord.errors
+import discord
 from discord import app_commands, Interaction
 from discord.ext import commands
 
-from utils.database import db_exec, remove_user
-from utils.functions import get_last_message_time, get_whitelist
+from utils.database import db_read, to_epoch_ms, get_running_kick_jobs, get_kick_job
+from utils.functions import get_inactive_members, get_whitelist, refresh_members
+from utils.globals import KICK_CONCURRENCY
+from utils.kickjobs import kick_jobs
 from utils.syncmanager import sync_manager
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+
+async def send_followup(interaction: Interaction, content):
+    """
+    Sends a followup message, or a plain message in the same channel if the
+    interaction token has expired - they only last 15 minutes, and a big prune
+    can take longer than that.
+    """
+    try:
+        await interaction.followup.send(content)
+    except discord.HTTPException as e:
+        logger.debug(f"Couldn't send followup, sending to the channel instead: {str(e)}")
+        try:
+            await interaction.channel.send(content)
+        except Exception as e:
+            logger.error(f"Couldn't report kick results in {interaction.guild.name}: {str(e)}")
+
+
 class Moderation(commands.Cog):
+    kick_job = app_commands.Group(
+        name="kick_job",
+        description="Check on or cancel kick jobs.",
+        default_permissions=discord.Permissions(administrator=True)
+    )
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
@@ -33,46 +58,58 @@ class Moderation(commands.Cog):
             await interaction.response.send_message("That's an awful lot of message history I need to sort through... Try a period less than or equal to 60 days perhaps. :thinking:", ephemeral=True)
             return
 
+        guild = interaction.guild
+        running_jobs = await db_read(get_running_kick_jobs, guild.id)
+        if running_jobs:
+            await interaction.response.send_message(
+                f"Kick job #{running_jobs[0]['job_id']} is still running - check on it with /kick_job status, "
+                f"or stop it with /kick_job cancel.",
+                ephemeral=True
+            )
+            return
+
         logger.debug(f"Command received - /kick_inactive {n}")
         await interaction.response.send_message(f"Kicking members who haven't sent a message in the last {n} days...")
-        guild = interaction.guild
 
-        user_last_message = await get_last_message_time(guild)
-        inactive_members = []
+        # Always work from an up to date member list before kicking anyone
+        members = await refresh_members(guild, max_age=0)
+
         inactive_whitelisted_members = []
-        cutoff_date = datetime.now(timezone.utc) - timedelta(days=n)
-
-        whitelist = get_whitelist(guild)
-        missing_perms = False
-
-        for member in guild.members:
-            if not (member.bot or member == guild.owner):
-                last_message_time = user_last_message.get(member.id)
-
-                logger.debug(f"{member.name} lm {last_message_time} co {cutoff_date}")
-
-                if last_message_time is None or last_message_time < cutoff_date:
-                    if member.id not in whitelist:
-                        try:
-                            await member.kick(reason=f"Inactive in {guild.name} for {n} days")
-                            inactive_members.append(member.name)
-                            logger.info(f"Kicked {member.name} in {guild.name} for inactivity.")
-                            await db_exec(
-                                remove_user,
-                                guild.id,
-                                member.id
-                            )
-                        except discord.errors.Forbidden:
-                            logger.error(f"Missing permissions to kick {member.name}.")
-                            missing_perms = True
-                            break
-                        except Exception as e:
-                            logger.error(f'Error kicking {member.name}: {str(e)}')
-                    else:
-                        inactive_whitelisted_members.append(member.name)
+        cutoff_date = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=n))
+
+        whitelist = await get_whitelist(guild)
+        targets = []
+
+        for member_id, member_name in await get_inactive_members(guild, cutoff_date):
+            if member_id in whitelist:
+                inactive_whitelisted_members.append(member_name)
+                continue
+
+            member = members.get(member_id) if members is not None else guild.get_member(member_id)
+            if member is not None:
+                targets.append(member)
+
+        async def show_progress(done, total):
+            await interaction.edit_original_response(
+                content=f"Kicking members who haven't sent a message in the last {n} days... ({done}/{total})"
+            )
+
+        job_id = await kick_jobs.create(guild, interaction.channel_id, n, targets)
+        if job_id is None:
+            # Someone else started one while the member list was downloading
+            await send_followup(interaction, "Another kick job was started in the meantime - check on it with /kick_job status.")
+            return
+
+        executor = await kick_jobs.run(job_id, guild, n, targets, KICK_CONCURRENCY, on_progress=show_progress)
+        missing_perms = executor.missing_perms
+        inactive_members = [member.name for member in executor.kicked]
+
+        if executor.stopped:
+            await send_followup(interaction, f"Kick job #{job_id} was cancelled.")
 
         if missing_perms:
-            await interaction.followup.send(
+            await send_followup(
+                interaction,
                 "Kicking members aborted due to insufficient permissions.\n\n" +
                 "Hint: This is likely caused by the bot's role being too low " +
                 "in the server hierarchy.\nCheck that the bot's role is above" +
@@ -104,7 +141,47 @@ class Moderation(commands.Cog):
         if inactive_whitelisted_members:
             response_str += f"\n\n({str(len(inactive_whitelisted_members))} whitelisted members spared)"
 
-        await interaction.followup.send(response_str)
+        await send_followup(interaction, response_str)
+
+    @kick_job.command(name="status", description="Show the progress of a kick job.")
+    @app_commands.describe(job_id="ID of the job. Defaults to the latest job.")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def kick_job_status(self, interaction: Interaction, job_id: int = None):
+        logger.debug(f"Command received - /kick_job status {job_id}")
+        result = await db_read(get_kick_job, interaction.guild.id, job_id)
+        if result is None:
+            await interaction.response.send_message("No kick job found.", ephemeral=True)
+            return
+
+        job, counts = result
+        total = sum(counts.values())
+        created_at = job["created_at"] // 1000
+
+        await interaction.response.send_message(
+            f"**Kick job #{job['job_id']}** - {job['status']}\n"
+            f"Started <t:{created_at}:R> for members inactive for {job['days']} days\n\n"
+            f"Kicked: {counts.get('kicked', 0)}/{total}\n"
+            f"Pending: {counts.get('pending', 0)}\n"
+            f"Failed: {counts.get('failed', 0)}\n"
+            f"Whitelisted since the job started: {counts.get('whitelisted', 0)}\n"
+            f"Left before being kicked: {counts.get('gone', 0)}",
+            ephemeral=True
+        )
+
+    @kick_job.command(name="cancel", description="Stop a running kick job.")
+    @app_commands.describe(job_id="ID of the job to cancel.")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def kick_job_cancel(self, interaction: Interaction, job_id: int):
+        logger.debug(f"Command received - /kick_job cancel {job_id}")
+        result = await db_read(get_kick_job, interaction.guild.id, job_id)
+        if result is None:
+            await interaction.response.send_message(f"No kick job #{job_id} found.", ephemeral=True)
+            return
+
+        if await kick_jobs.cancel(job_id):
+            await interaction.response.send_message(f"Kick job #{job_id} cancelled.", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"Kick job #{job_id} has already finished.", ephemeral=True)
 
     # @app_commands.command(name="ban", description='"Bans" a user :3')
     # @app_commands.describe(user="The user to ban")
@@ -0,0 +1,77 @@
+import logging
+
+from discord import app_commands, Interaction
+from discord.ext import commands
+
+from utils.database import db_queue_depths
+from utils.metrics import DB_LATENCY, MESSAGES_INGESTED, CHANNEL_SYNC_DURATION, KICKS, uptime
+from utils.syncmanager import sync_manager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Number of database functions shown, busiest first
+STATS_DB_FUNCTIONS = 8
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+class Stats(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @app_commands.command(name="stats", description="Show the bot's performance statistics.")
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def stats(self, interaction: Interaction):
+        logger.debug("Command received - /stats")
+        seconds = uptime()
+        hours, rem = divmod(int(seconds), 3600)
+
+        live = MESSAGES_INGESTED.total(source="live")
+        synced = MESSAGES_INGESTED.total(source="sync")
+
+        response_str = f"**Uptime:** {hours}h {rem // 60:02d}m\n\n"
+        response_str += "**Messages**\n"
+        response_str += f"Live: {live} ({live / seconds:.2f}/s)\n"
+        response_str += f"History sync: {synced} ({synced / seconds:.2f}/s)\n\n"
+
+        response_str += "**Database** (calls, avg, p95)\n"
+        busiest = sorted(DB_LATENCY.values.items(), key=lambda item: item[1][2], reverse=True)
+        for key, (_, total, count) in busiest[:STATS_DB_FUNCTIONS]:
+            function, mode = key
+            response_str += (f"`{function}` ({mode}): {count}, {_ms(total / count)}, "
+                             f"{_ms(DB_LATENCY.quantile(0.95, key))}\n")
+        if not busiest:
+            response_str += "No calls yet\n"
+
+        depths = db_queue_depths()
+        response_str += "\n**Queued tasks**\n"
+        for queue, lanes in depths.items():
+            response_str += f"{queue.capitalize()}: " + ", ".join(f"{lane} {depth}" for lane, depth in lanes.items()) + "\n"
+
+        channel_syncs = CHANNEL_SYNC_DURATION.values.get(())
+        if channel_syncs is not None:
+            _, total, count = channel_syncs
+            response_str += (f"\n**Channel syncs:** {count}, avg {total / count:.2f}s, "
+                             f"p95 {CHANNEL_SYNC_DURATION.quantile(0.95, ())}s\n")
+
+        shard_states = sync_manager.shard_states()
+        if shard_states:
+            latencies = dict(self.bot.latencies)
+            response_str += "\n**Shards**\n"
+            for shard_id, synced in sorted(shard_states.items()):
+                latency = latencies.get(shard_id)
+                response_str += (f"{shard_id}: {'synced' if synced else 'syncing'}, "
+                                 f"latency {_ms(latency)}\n")
+
+        response_str += (f"\n**Kicks:** {KICKS.total(result='kicked')} kicked, "
+                         f"{KICKS.total(result='failed')} failed")
+
+        await interaction.response.send_message(response_str, ephemeral=True)
+
+
+async def setup(bot):
+    await bot.add_cog(Stats(bot))
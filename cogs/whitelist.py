@@ -1,43 +1,98 @@
+import asyncio
 import logging
 
 import discord
 from discord import app_commands, Interaction
 from discord.ext import commands
 
-from utils.functions import get_whitelist, set_whitelist
-from utils.globals import WHITELIST_DIR
-
-wl_dir = WHITELIST_DIR
+from utils.functions import get_whitelist, add_whitelist_member, remove_whitelist_member
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-async def get_whitelist_str(whitelist, guild):
-    whitelist_str = ""
+# Most user IDs a single query_members request can look up
+QUERY_MEMBERS_LIMIT = 100
+
+async def get_whitelist_str(whitelist, guild, names):
+    """
+    Lists the names of the whitelisted members. Names come from the member cache where
+    possible, and anyone missing from it is looked up in batches over the gateway. If
+    a lookup times out, the members still unresolved are shown as mentions instead.
+    :param whitelist: Whitelisted user IDs
+    :param guild: The guild the whitelist belongs to
+    :param names: Cache of user ID to display name for this guild, filled in as
+        members are resolved
+    """
+    unresolved = []
     for wl_id in whitelist:
-        try:
-            member = await guild.fetch_member(wl_id)
-            whitelist_str += f"\n{member}"
-        except discord.NotFound:
-            # If a user has left the server, don't add their ID
-            pass
+        if wl_id in names:
+            continue
+
+        member = guild.get_member(wl_id)
+        if member is not None:
+            names[wl_id] = str(member)
+        else:
+            unresolved.append(wl_id)
 
-    return whitelist_str
+    timed_out = set()
+    for i in range(0, len(unresolved), QUERY_MEMBERS_LIMIT):
+        batch = unresolved[i:i + QUERY_MEMBERS_LIMIT]
+        try:
+            members = await guild.query_members(limit=QUERY_MEMBERS_LIMIT, user_ids=batch)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out looking up whitelisted members in {guild.name}")
+            timed_out.update(unresolved[i:])
+            break
+
+        for member in members:
+            names[member.id] = str(member)
+
+    # If a user has left the server, don't add their ID
+    return "".join(
+        f"\n{names[wl_id]}" if wl_id in names else f"\n<@{wl_id}>"
+        for wl_id in sorted(whitelist)
+        if wl_id in names or wl_id in timed_out
+    )
 
 class WhiteList(commands.GroupCog, name="whitelist"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+        # guild ID -> user ID -> display name
+        self.display_names = {}
+
+    def names_for(self, guild):
+        return self.display_names.setdefault(guild.id, {})
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.names_for(member.guild).pop(member.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        self.names_for(after.guild).pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        for names in self.display_names.values():
+            names.pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.display_names.pop(guild.id, None)
+
     @app_commands.command(name="show", description="Show the whitelist.")
     @app_commands.checks.has_permissions(administrator=True)
     async def show(self, interaction: Interaction):
         logger.debug("Command received - /whitelist show")
         guild = interaction.guild
-        whitelist = get_whitelist(guild)
+        whitelist = await get_whitelist(guild)
         if len(whitelist) > 0:
-            whitelist_str = await get_whitelist_str(whitelist, guild)
+            # Looking up names can take longer than the 3 seconds allowed to respond
+            await interaction.response.defer(ephemeral=True)
+            whitelist_str = await get_whitelist_str(whitelist, guild, self.names_for(guild))
 
-            await interaction.response.send_message(
+            await interaction.followup.send(
                 f"**Whitelisted members (will not be kicked out even when inactive):** \n{whitelist_str}",
                 ephemeral=True
             )
@@ -51,21 +106,21 @@ class WhiteList(commands.GroupCog, name="whitelist"):
         name = user.name
         logger.debug(f"Command received - /whitelist add {name}")
         guild = interaction.guild
-        existing_members = get_whitelist(guild)
-        if user not in guild.members:
+        existing_members = await get_whitelist(guild)
+        if not isinstance(user, discord.Member):
             await interaction.response.send_message(f"**User {name} does not exist or is not a member of this server**",
                                                     ephemeral=True)
             return
         if user.id in existing_members:
             await interaction.response.send_message(f"**User {name} is already on the whitelist**", ephemeral=True)
             return
-        new_members = existing_members + [user.id]
 
-        set_whitelist(guild, new_members)
+        await interaction.response.defer(ephemeral=True)
+        await add_whitelist_member(guild, user.id)
 
-        whitelist_str = await get_whitelist_str(new_members, guild)
+        whitelist_str = await get_whitelist_str(await get_whitelist(guild), guild, self.names_for(guild))
 
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"**User {name} was added to the whitelist**\nThe whitelist currently contains the following users:\n{whitelist_str}",
             ephemeral=True
         )
@@ -77,21 +132,21 @@ class WhiteList(commands.GroupCog, name="whitelist"):
         name = user.name
         logger.debug(f"Command received - /whitelist remove {name}")
         guild = interaction.guild
-        existing_members = get_whitelist(guild)
-        if user not in guild.members:
+        existing_members = await get_whitelist(guild)
+        if not isinstance(user, discord.Member):
             await interaction.response.send_message(f"**User {name} does not exist or is not a member of this server**",
                                                     ephemeral=True)
             return
         if user.id not in existing_members:
             await interaction.response.send_message(f"**User {name} is not currently on the whitelist**", ephemeral=True)
             return
-        existing_members.remove(user.id)
 
-        set_whitelist(guild, existing_members)
+        await interaction.response.defer(ephemeral=True)
+        await remove_whitelist_member(guild, user.id)
 
-        whitelist_str = await get_whitelist_str(existing_members, guild)
+        whitelist_str = await get_whitelist_str(await get_whitelist(guild), guild, self.names_for(guild))
 
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"**User {name} was removed from the whitelist**\nThe whitelist currently contains the following users:\n{whitelist_str}",
             ephemeral=True
         )
@@ -7,11 +7,17 @@ from time import perf_counter
 
 import discord
 from discord import app_commands
-from discord.ext import commands
-
-from utils.database import db_exec, add_timestamp, db_close, is_db_stopped
-from utils.functions import fetch_messages
+from discord.ext import commands, tasks
+
+from utils.activitycache import activity_cache, FLUSH_INTERVAL
+from utils.activityindex import activity_index
+from utils.database import db_exec, db_close, is_db_stopped, to_epoch_ms, add_member, rename_user, \
+    remove_guild_data, LANE_LIVE
+from utils.functions import sync_guild, sync_guilds, run_retention, import_whitelist_files, forget_whitelist, \
+    RETENTION_INTERVAL
 from utils.globals import setup
+from utils.kickjobs import kick_jobs
+from utils.metrics import MESSAGES_INGESTED, start_metrics_server
 from utils.syncmanager import sync_manager
 
 intents = discord.Intents.default()
@@ -20,8 +26,6 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-
 rlogger = logging.getLogger()
 rlogger.setLevel(logging.INFO)
 
@@ -45,6 +49,23 @@ logger = logging.getLogger(__name__)
 
 api_token = setup()
 
+
+def make_bot():
+    from utils.globals import SHARD_COUNT, SHARD_IDS, LAZY_MEMBERS
+
+    # With neither set, discord.py asks Discord how many shards to run and runs them all
+    return commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS,
+        # In lazy mode, member lists are only downloaded when a command needs them
+        chunk_guilds_at_startup=not LAZY_MEMBERS
+    )
+
+
+bot = make_bot()
+
 @bot.event
 async def on_message(message):
     if message.author.bot:
@@ -55,50 +76,108 @@ async def on_message(message):
     guild_id = message.guild.id
     author_id = message.author.id
     author_name = message.author.name
-    timestamp = message.created_at
+    timestamp = to_epoch_ms(message.created_at)
 
     logger.debug("Received message")
+    MESSAGES_INGESTED.inc(source="live")
 
-    await db_exec(
-        add_timestamp,
-        guild_id,
-        author_id,
-        author_name,
-        timestamp
-    )
+    # In lazy member mode the stored member list the index was loaded from can be
+    # missing people who joined while the bot was offline
+    if activity_index.is_loaded(guild_id) and not activity_index.has_member(guild_id, author_id):
+        activity_index.add_member(guild_id, author_id, author_name)
+        await db_exec(add_member, guild_id, author_id, author_name, False, lane=LANE_LIVE, ordered=True)
+
+    activity_index.update(guild_id, author_id, timestamp, author_name)
+
+    if activity_cache.add(guild_id, author_id, author_name, timestamp):
+        logger.debug("Activity cache full - flushing")
+        await activity_cache.flush()
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_activity_cache():
+    await activity_cache.flush()
+
+@tasks.loop(hours=RETENTION_INTERVAL)
+async def retention():
+    await run_retention([guild.id for guild in bot.guilds], bot.shard_ids, bot.shard_count)
+
+@retention.before_loop
+async def before_retention():
+    # bot.guilds is only complete once the bot is ready
+    await bot.wait_until_ready()
+
+@bot.event
+async def on_member_join(member):
+    activity_cache.cancel_removal(member.guild.id, member.id)
+    if not member.bot:
+        activity_index.add_member(member.guild.id, member.id, member.name)
+    await db_exec(add_member, member.guild.id, member.id, member.name, member.bot, lane=LANE_LIVE, ordered=True)
+
+@bot.event
+async def on_raw_member_remove(payload):
+    # on_member_remove only fires for cached members, which in lazy member mode
+    # is hardly anyone
+    activity_index.remove_member(payload.guild_id, payload.user.id)
+    if activity_cache.remove(payload.guild_id, payload.user.id):
+        await activity_cache.flush()
+
+@bot.event
+async def on_member_update(before, after):
+    if before.name != after.name:
+        activity_index.rename_user(after.id, after.name)
+        await db_exec(add_member, after.guild.id, after.id, after.name, after.bot, lane=LANE_LIVE, ordered=True)
+
+@bot.event
+async def on_user_update(before, after):
+    # Username changes come through here rather than on_member_update
+    if before.name != after.name:
+        activity_index.rename_user(after.id, after.name)
+        await db_exec(rename_user, after.id, after.name, lane=LANE_LIVE, ordered=True)
 
 @bot.event
 async def on_guild_join(guild):
     logger.info("Joined new guild - starting sync")
-    async with sync_manager.lock:
-        sync_manager.add_guilds((guild,))
-        await fetch_messages(guild)
-        sync_manager.finish_syncing()
+    sync_manager.add_guilds((guild,))
+    await sync_guild(guild)
 
 @bot.event
 async def on_guild_remove(guild):
     logger.info(f"Left guild {guild.name}")
-    async with sync_manager.lock:
+    async with sync_manager.lock(guild.id):
         sync_manager.remove_guild(guild.id)
+        activity_cache.remove_guild(guild.id)
+        activity_index.remove_guild(guild.id)
+        forget_whitelist(guild.id)
+        await db_exec(remove_guild_data, guild.id, lane=LANE_LIVE)
 
 @bot.event
 async def on_ready():
-    logger.info(f'Logged in as {bot.user.name} - Now syncing command tree')
+    # Fires once every shard in this process is connected - each shard's guilds
+    # are synced from on_shard_ready.
+    logger.info(f'Logged in as {bot.user.name} with shards {sorted(bot.shards)} of {bot.shard_count}')
 
-    start = perf_counter()
-    await bot.tree.sync()
-    end = perf_counter()
+    # Commands are global, so when the shards are split between processes only
+    # the one running shard 0 needs to sync them.
+    if 0 in bot.shards:
+        logger.info("Syncing command tree")
+        start = perf_counter()
+        await bot.tree.sync()
+        end = perf_counter()
 
-    logger.info(f"Command tree sync finished. Time taken: {int((end-start)//60):02d}:{(end-start)%60:05.2f}")
+        logger.info(f"Command tree sync finished. Time taken: {int((end-start)//60):02d}:{(end-start)%60:05.2f}")
+
+    from utils.globals import KICK_CONCURRENCY
+    await kick_jobs.resume(bot, KICK_CONCURRENCY)
+
+@bot.event
+async def on_shard_ready(shard_id):
+    guilds = [guild for guild in bot.guilds if guild.shard_id == shard_id]
+    logger.info(f"Shard {shard_id} ready - starting message sync for {len(guilds)} guilds")
 
-    logger.info("Starting message sync")
-    async with sync_manager.lock:
-        sync_manager.add_guilds(bot.guilds)
-        for guild in bot.guilds:
-            await fetch_messages(guild)
-            await asyncio.sleep(0.05)
-        sync_manager.finish_syncing()
-    logger.info("Ready for your commands!")
+    sync_manager.start_shard(shard_id)
+    await sync_guilds(guilds)
+    sync_manager.finish_shard(shard_id)
+    logger.info(f"Shard {shard_id} ready for your commands!")
 
 
 @bot.tree.error
@@ -129,12 +208,29 @@ async def load_cogs():
     await bot.load_extension("cogs.activity")
     await bot.load_extension("cogs.moderation")
     await bot.load_extension("cogs.whitelist")
+    await bot.load_extension("cogs.stats")
 
 
 async def main():
     async with bot:
         await load_cogs()
-        await bot.start(api_token)
+        await import_whitelist_files()
+        flush_activity_cache.start()
+        retention.start()
+
+        from utils.globals import METRICS_PORT
+        metrics_runner = await start_metrics_server(METRICS_PORT) if METRICS_PORT is not None else None
+
+        try:
+            await bot.start(api_token)
+        finally:
+            # Write out anything still buffered before the DB thread is stopped
+            flush_activity_cache.cancel()
+            retention.cancel()
+            await activity_cache.flush()
+
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
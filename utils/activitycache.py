@@ -0,0 +1,150 @@
+import asyncio
+import logging
+
+from utils.database import db_exec, write_activity, merge_day_bits, LANE_LIVE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# How often buffered timestamps are written out, in seconds, and how many
+# (guild, user) entries can be held before a write is forced.
+FLUSH_INTERVAL = 30
+DEFAULT_MAX_SIZE = 10000
+
+
+class ActivityCache:
+    """
+    Buffers the latest message timestamp for each (guild, user) pair so chatty users
+    cost one database write per flush instead of one per message. Anything reading
+    last active times should merge in the buffered values with get/get_guild.
+
+    The days each user was active on are buffered alongside, as day_bits, so a buffer
+    that spans midnight still records both days.
+
+    Members leaving are buffered too, and deleted in the same flush.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+
+        # guild_id -> user_id -> (uname, timestamp, day_bits)
+        self._pending = {}
+        self._pending_count = 0
+
+        # (guild_id, user_id) pairs of members who have left
+        self._removed = set()
+
+        # Entries currently being written - still visible to readers until the
+        # write has gone through.
+        self._flushing = {}
+        self._removing = set()
+
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return self._pending_count + len(self._removed)
+
+    def add(self, guild_id, user_id, uname, timestamp, day_bits=1):
+        """
+        Buffers a message timestamp, keeping only the newest one per user.
+        :param day_bits: Days the user was active on, anchored at the day of timestamp
+        :return: True if the cache is full and should be flushed.
+        """
+        guild_entries = self._pending.setdefault(guild_id, {})
+        existing = guild_entries.get(user_id)
+        if existing is None:
+            self._pending_count += 1
+            guild_entries[user_id] = (uname, timestamp, day_bits)
+        else:
+            latest, merged = merge_day_bits(existing[1], existing[2], timestamp, day_bits)
+            guild_entries[user_id] = (uname if timestamp > existing[1] else existing[0], latest, merged)
+
+        return len(self) >= self.max_size
+
+    def remove(self, guild_id, user_id):
+        """
+        Buffers a member leaving, dropping anything buffered for them.
+        :return: True if the cache is full and should be flushed.
+        """
+        guild_entries = self._pending.get(guild_id, {})
+        if guild_entries.pop(user_id, None) is not None:
+            self._pending_count -= 1
+
+        self._removed.add((guild_id, user_id))
+        return len(self) >= self.max_size
+
+    def cancel_removal(self, guild_id, user_id):
+        """
+        Forgets a buffered removal, for members who rejoin before it was written out.
+        """
+        self._removed.discard((guild_id, user_id))
+
+    def is_removed(self, guild_id, user_id):
+        return (guild_id, user_id) in self._removed or (guild_id, user_id) in self._removing
+
+    def remove_guild(self, guild_id):
+        """
+        Drops everything buffered for a guild.
+        """
+        self._pending_count -= len(self._pending.pop(guild_id, {}))
+        self._removed = {entry for entry in self._removed if entry[0] != guild_id}
+
+    def get(self, guild_id, user_id):
+        """
+        :return: The newest buffered timestamp for the user, or None if nothing is buffered.
+        """
+        latest = None
+        for entries in (self._flushing, self._pending):
+            entry = entries.get(guild_id, {}).get(user_id)
+            if entry is not None and (latest is None or entry[1] > latest):
+                latest = entry[1]
+
+        return latest
+
+    def get_guild(self, guild_id):
+        """
+        :return: A dict of user ID to newest buffered timestamp for everyone buffered in the guild.
+        """
+        latest = {}
+        for entries in (self._flushing, self._pending):
+            for user_id, (_, timestamp, _) in entries.get(guild_id, {}).items():
+                if user_id not in latest or timestamp > latest[user_id]:
+                    latest[user_id] = timestamp
+
+        return latest
+
+    async def flush(self):
+        async with self.lock:
+            if len(self) == 0:
+                return
+
+            self._flushing = self._pending
+            self._pending = {}
+            count = self._pending_count
+            self._pending_count = 0
+
+            self._removing = self._removed
+            self._removed = set()
+
+            rows = [
+                (guild_id, user_id, uname, timestamp, day_bits)
+                for guild_id, entries in self._flushing.items()
+                for user_id, (uname, timestamp, day_bits) in entries.items()
+            ]
+
+            try:
+                # Removals mustn't overtake history sync pages still queued for
+                # the same members, or the pages would bring their rows back
+                await db_exec(write_activity, rows, self._removing, lane=LANE_LIVE, ordered=bool(self._removing))
+                logger.debug(f"Flushed {count} buffered timestamps and {len(self._removing)} removals.")
+            except Exception:
+                # Put the entries back so they go out with the next flush.
+                for guild_id, user_id, uname, timestamp, day_bits in rows:
+                    self.add(guild_id, user_id, uname, timestamp, day_bits)
+                self._removed |= self._removing
+                raise
+            finally:
+                self._flushing = {}
+                self._removing = set()
+
+
+activity_cache = ActivityCache()
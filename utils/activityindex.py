@@ -0,0 +1,197 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Bucket for members who have never sent a message
+NEVER = -1
+
+
+class GuildActivity:
+    """
+    Last active times for the human members of one guild. Members are bucketed by the
+    day of their last message, so finding everyone inactive since a cutoff only
+    touches the buckets before it, and moving a member costs two set operations.
+    """
+    __slots__ = ("times", "names", "buckets")
+
+    def __init__(self):
+        # user_id -> timestamp in milliseconds since the epoch, or None
+        self.times = {}
+        self.names = {}
+
+        # day number (or NEVER) -> set of user IDs
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def _day(timestamp):
+        return NEVER if timestamp is None else timestamp // DAY_MS
+
+    def _move(self, user_id, old, new):
+        old_day = self._day(old)
+        new_day = self._day(new)
+        if old_day == new_day and user_id in self.times:
+            return
+
+        if user_id in self.times:
+            bucket = self.buckets[old_day]
+            bucket.discard(user_id)
+            if not bucket:
+                del self.buckets[old_day]
+
+        self.buckets.setdefault(new_day, set()).add(user_id)
+
+    def add_member(self, user_id, uname, timestamp=None):
+        self.names[user_id] = uname
+        if user_id not in self.times:
+            self._move(user_id, None, timestamp)
+            self.times[user_id] = timestamp
+        else:
+            self.update(user_id, timestamp)
+
+    def remove_member(self, user_id):
+        if user_id not in self.times:
+            return
+
+        timestamp = self.times.pop(user_id)
+        self.names.pop(user_id, None)
+        day = self._day(timestamp)
+        bucket = self.buckets[day]
+        bucket.discard(user_id)
+        if not bucket:
+            del self.buckets[day]
+
+    def update(self, user_id, timestamp, uname=None):
+        if timestamp is None:
+            return
+
+        # Only members are tracked - history sync also sees people who have left
+        if user_id not in self.times:
+            return
+
+        if uname is not None:
+            self.names[user_id] = uname
+
+        old = self.times[user_id]
+        if old is None or timestamp > old:
+            self._move(user_id, old, timestamp)
+            self.times[user_id] = timestamp
+
+    def get(self, user_id):
+        return self.times.get(user_id)
+
+    def inactive(self, cutoff):
+        """
+        :param cutoff: Timestamp in milliseconds since the epoch
+        :return: A list of (user_id, uname) tuples for members with no message since the cutoff
+        """
+        cutoff_day = cutoff // DAY_MS
+        inactive = []
+
+        for day, users in self.buckets.items():
+            if day < cutoff_day:
+                inactive.extend((user_id, self.names[user_id]) for user_id in users)
+            elif day == cutoff_day:
+                inactive.extend(
+                    (user_id, self.names[user_id]) for user_id in users
+                    if self.times[user_id] < cutoff
+                )
+
+        return inactive
+
+
+class ActivityIndex:
+    """
+    In-memory last active times for every guild, so commands don't need to go to the
+    database. A guild is loaded from the database when it syncs, and kept current from
+    then on by on_message, history sync and member events.
+    """
+    def __init__(self):
+        self._guilds = {}
+
+    def load(self, guild_id, rows):
+        """
+        Replaces the guild's entries.
+        :param guild_id: ID of the guild
+        :param rows: Iterable of (user_id, uname, timestamp) tuples, with timestamp None
+            for members who have never sent a message.
+        """
+        guild = GuildActivity()
+        for user_id, uname, timestamp in rows:
+            guild.add_member(int(user_id), uname, timestamp)
+
+        self._guilds[guild_id] = guild
+        logger.debug(f"Loaded {len(guild)} members into activity index for {guild_id}")
+
+    def is_loaded(self, guild_id):
+        return guild_id in self._guilds
+
+    def has_member(self, guild_id, user_id):
+        guild = self._guilds.get(guild_id)
+        return guild is not None and user_id in guild.times
+
+    def remove_guild(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+    def add_member(self, guild_id, user_id, uname):
+        guild = self._guilds.get(guild_id)
+        if guild is not None:
+            guild.add_member(user_id, uname)
+
+    def remove_member(self, guild_id, user_id):
+        guild = self._guilds.get(guild_id)
+        if guild is not None:
+            guild.remove_member(user_id)
+
+    def set_members(self, guild_id, rows):
+        """
+        Brings a loaded guild's members in line with a fresh member list, keeping the
+        last active times of members who are still there.
+        :param guild_id: ID of the guild
+        :param rows: Iterable of (user_id, uname, timestamp) tuples for the guild's human
+            members, with timestamp None for members who have never sent a message.
+        """
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            return
+
+        current = set()
+        for user_id, uname, timestamp in rows:
+            current.add(user_id)
+            guild.add_member(user_id, uname, timestamp)
+
+        for user_id in [user_id for user_id in guild.times if user_id not in current]:
+            guild.remove_member(user_id)
+
+    def rename_user(self, user_id, uname):
+        for guild in self._guilds.values():
+            if user_id in guild.names:
+                guild.names[user_id] = uname
+
+    def update(self, guild_id, user_id, timestamp, uname=None):
+        guild = self._guilds.get(guild_id)
+        if guild is not None:
+            guild.update(user_id, timestamp, uname)
+
+    def get(self, guild_id, user_id):
+        """
+        :return: The user's last active time in milliseconds since the epoch, or None
+        """
+        guild = self._guilds.get(guild_id)
+        return guild.get(user_id) if guild is not None else None
+
+    def inactive(self, guild_id, cutoff):
+        """
+        :return: A list of (user_id, uname) tuples for members of the guild with no
+            message since the cutoff, or None if the guild isn't loaded.
+        """
+        guild = self._guilds.get(guild_id)
+        return guild.inactive(cutoff) if guild is not None else None
+
+
+activity_index = ActivityIndex()
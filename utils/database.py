@@ -1,45 +1,356 @@
 import asyncio
 import logging
-import queue
 import sqlite3
+from collections import deque
 import threading
+import time
+from datetime import datetime, timezone, timedelta
 
 from queue import Empty
 
+from utils.metrics import DB_LATENCY, Gauge
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Group commit settings. The worker thread keeps pulling tasks off the queue
+# until it has DEFAULT_BATCH_SIZE of them, or until DEFAULT_BATCH_WINDOW seconds
+# have passed since the first write in the batch, then commits everything at once.
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_BATCH_WINDOW = 0.005
+
+# Number of read-only connections serving db_read, alongside the single writer.
+DEFAULT_READERS = 2
+
+# Priority lanes for database tasks, highest priority first. Slash commands go
+# ahead of live message writes, which go ahead of history sync and other
+# background work.
+LANE_INTERACTIVE = 0
+LANE_LIVE = 1
+LANE_BACKFILL = 2
+LANE_NAMES = ("interactive", "live", "backfill")
+
+# A task that has waited this many seconds can be run ahead of higher lanes, so
+# a busy lane can't starve the ones below it - but only one task in every
+# STARVED_EVERY, so a backlog of starved tasks can't hold up interactive work.
+STARVATION_LIMIT = 0.5
+STARVED_EVERY = 4
+
+DB_PATH = "activity.db"
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Each member's day_bits records which of the last ACTIVITY_DAYS days they sent a
+# message on. Bit 0 is the day of their last message, bit n the day n days before.
+ACTIVITY_DAYS = 60
+DAY_BITS_MASK = (1 << ACTIVITY_DAYS) - 1
+
+# Seconds a connection waits for another one to release its lock before giving up.
+# Only matters when several bot processes share the database.
+BUSY_TIMEOUT = 30
+
+
+def _split_statements(script):
+    """
+    Splits a migration script into statements, so it can be run within a
+    transaction that's already open - executescript always commits first.
+    """
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+
+    if statement.strip():
+        statements.append(statement)
+    return statements
+
+
+def _enable_incremental_vacuum(conn):
+    # Changing auto_vacuum on an existing database only takes effect after a
+    # VACUUM, which can't be run inside a transaction.
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    conn.execute("VACUUM;")
+
+
+# Schema migrations, applied in order. The database's PRAGMA user_version holds
+# the number of migrations that have been applied, so only ever add to the end
+# of this list - never edit a migration that has already been released.
+# Migrations are either SQL scripts, which run in a transaction, or functions
+# taking the connection for anything that can't. Functions must be safe to run
+# more than once. Keep each SQL statement on its own lines.
+MIGRATIONS = [
+    # 1 - Initial schema. Databases created before migrations existed already
+    # have some of these tables, hence IF NOT EXISTS.
+    """
+    CREATE TABLE IF NOT EXISTS last_message (
+        guild_id    TEXT NOT NULL,
+        user_id     TEXT NOT NULL,
+        uname       TEXT NOT NULL,
+        timestamp   DATETIME NOT NULL,
+        PRIMARY KEY(guild_id, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS sync_progress (
+        guild_id    TEXT PRIMARY KEY NOT NULL,
+        timestamp   DATETIME NOT NULL,
+        synced      BOOLEAN NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS channel_cursor (
+        guild_id    TEXT NOT NULL,
+        channel_id  TEXT NOT NULL,
+        message_id  INTEGER NOT NULL,
+        PRIMARY KEY(guild_id, channel_id)
+    );
+    """,
+
+    # 2 - Index for latest/range timestamp lookups within a guild
+    """
+    CREATE INDEX IF NOT EXISTS last_message_guild_timestamp
+    ON last_message(guild_id, timestamp);
+    """,
+
+    # 3 - Store timestamps as integer milliseconds since the Unix epoch instead of
+    # ISO 8601 text. Rows whose timestamp can't be parsed are dropped - they would
+    # never have compared correctly anyway.
+    """
+    CREATE TABLE last_message_new (
+        guild_id    TEXT NOT NULL,
+        user_id     TEXT NOT NULL,
+        uname       TEXT NOT NULL,
+        timestamp   INTEGER NOT NULL,
+        PRIMARY KEY(guild_id, user_id)
+    );
+
+    INSERT INTO last_message_new(guild_id, user_id, uname, timestamp)
+    SELECT guild_id, user_id, uname,
+        CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER)
+    FROM last_message
+    WHERE julianday(timestamp) IS NOT NULL;
+
+    DROP TABLE last_message;
+    ALTER TABLE last_message_new RENAME TO last_message;
+
+    CREATE INDEX last_message_guild_timestamp
+    ON last_message(guild_id, timestamp);
+
+    CREATE TABLE sync_progress_new (
+        guild_id    TEXT PRIMARY KEY NOT NULL,
+        timestamp   INTEGER NOT NULL,
+        synced      BOOLEAN NOT NULL
+    );
+
+    INSERT INTO sync_progress_new(guild_id, timestamp, synced)
+    SELECT guild_id,
+        CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER),
+        synced
+    FROM sync_progress
+    WHERE julianday(timestamp) IS NOT NULL;
+
+    DROP TABLE sync_progress;
+    ALTER TABLE sync_progress_new RENAME TO sync_progress;
+    """,
+
+    # 4 - Member roster, kept up to date from gateway events
+    """
+    CREATE TABLE IF NOT EXISTS members (
+        guild_id    TEXT NOT NULL,
+        user_id     TEXT NOT NULL,
+        uname       TEXT NOT NULL,
+        bot         BOOLEAN NOT NULL,
+        PRIMARY KEY(guild_id, user_id)
+    );
+    """,
+
+    # 5 - Let the retention job hand freed pages back to the filesystem
+    _enable_incremental_vacuum,
+
+    # 6 - Whitelists, previously stored as one JSON file per guild
+    """
+    CREATE TABLE IF NOT EXISTS whitelist (
+        guild_id    TEXT NOT NULL,
+        user_id     TEXT NOT NULL,
+        PRIMARY KEY(guild_id, user_id)
+    );
+    """,
+
+    # 7 - Kick jobs, so a /kick_inactive run can be resumed after a restart
+    """
+    CREATE TABLE IF NOT EXISTS kick_jobs (
+        job_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id    TEXT NOT NULL,
+        channel_id  TEXT,
+        days        INTEGER NOT NULL,
+        status      TEXT NOT NULL,
+        created_at  INTEGER NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS kick_jobs_guild_status
+    ON kick_jobs(guild_id, status);
+
+    CREATE TABLE IF NOT EXISTS kick_targets (
+        job_id      INTEGER NOT NULL,
+        user_id     TEXT NOT NULL,
+        uname       TEXT NOT NULL,
+        status      TEXT NOT NULL,
+        PRIMARY KEY(job_id, user_id)
+    );
+    """,
+
+    # 8 - Days each member was active on. Existing rows only know about the day of
+    # the last message, so forget the sync cursors and progress to have the next sync
+    # crawl the whole retention window again - add_timestamps merges the older days in.
+    """
+    ALTER TABLE last_message ADD COLUMN day_bits INTEGER NOT NULL DEFAULT 0;
+
+    UPDATE last_message SET day_bits = 1;
+
+    DELETE FROM channel_cursor;
+
+    INSERT OR REPLACE INTO sync_progress(guild_id, timestamp, synced)
+    SELECT DISTINCT guild_id, 0, FALSE FROM last_message;
+    """,
+]
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_epoch_ms(dt: datetime) -> int:
+    """
+    Converts a timezone aware datetime to the integer milliseconds since the Unix
+    epoch that timestamps are stored as.
+    """
+    return (dt - _EPOCH) // timedelta(milliseconds=1)
+
+
+def from_epoch_ms(ms: int) -> datetime:
+    """
+    Converts a stored timestamp back to a UTC datetime.
+    """
+    return _EPOCH + timedelta(milliseconds=ms)
+
+
+def merge_day_bits(timestamp, day_bits, other_timestamp, other_bits):
+    """
+    Combines two day_bits bitmaps, each anchored at the day of its timestamp - the
+    same merge add_timestamps does in SQL.
+    :return: The later of the two timestamps, and the combined bitmap anchored at its day
+    """
+    day = timestamp // DAY_MS
+    other_day = other_timestamp // DAY_MS
+    latest_day = max(day, other_day)
+
+    combined = (day_bits << (latest_day - day)) | (other_bits << (latest_day - other_day))
+    return max(timestamp, other_timestamp), combined & DAY_BITS_MASK
+
+
+def _popcount(value):
+    return 0 if value is None else value.bit_count()
+
+
+class LaneQueue:
+    """
+    A thread-safe queue with a FIFO per priority lane. get() takes from the highest
+    priority lane with anything in it, except that every starved_every-th get() may
+    instead take the head of a lower lane that has waited longer than the starvation
+    limit. Behaves like queue.Queue for get/get_nowait, raising queue.Empty.
+
+    Items put with ordered set never overtake anything queued before them, whatever
+    its lane - for writes that touch the same rows as lower priority work.
+    """
+    def __init__(self, lanes=len(LANE_NAMES), starvation_limit=STARVATION_LIMIT,
+                 starved_every=STARVED_EVERY):
+        self._lanes = [deque() for _ in range(lanes)]
+        self._starvation_limit = starvation_limit
+        self._starved_every = starved_every
+        self._since_starved = starved_every
+        self._condition = threading.Condition()
+
+    def put(self, item, lane=LANE_INTERACTIVE, ordered=False):
+        with self._condition:
+            if ordered:
+                # Queue behind the lowest priority lane with anything waiting in it
+                lane = max([lane] + [i for i, queued in enumerate(self._lanes) if queued])
+            self._lanes[lane].append((time.monotonic(), item))
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(self._has_items, timeout):
+                raise Empty
+            return self._pop()
+
+    def get_nowait(self):
+        with self._condition:
+            if not self._has_items():
+                raise Empty
+            return self._pop()
+
+    def depths(self):
+        """
+        :return: A list of the number of queued tasks in each lane
+        """
+        with self._condition:
+            return [len(lane) for lane in self._lanes]
+
+    def _has_items(self):
+        return any(self._lanes)
+
+    def _pop(self):
+        starved_before = time.monotonic() - self._starvation_limit
+        chosen = None
+        starved = None
+
+        for lane in self._lanes:
+            if not lane:
+                continue
+            if chosen is None:
+                chosen = lane
+            # Of the starved lower lanes, the one that has waited longest
+            elif lane[0][0] < starved_before and (starved is None or lane[0][0] < starved[0][0]):
+                starved = lane
+
+        if starved is not None and self._since_starved >= self._starved_every:
+            chosen = starved
+            self._since_starved = 0
+        self._since_starved += 1
+
+        return chosen.popleft()[1]
+
 
 class Database:
-    def __init__(self):
-        self.tasks = queue.Queue()
+    """
+    Runs database functions in background threads. A single writer thread owns the
+    only connection allowed to modify the database, and a small pool of reader threads
+    with read-only connections serves db_read. The database is in WAL mode, so readers
+    see the last committed state without waiting on the writer.
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, batch_window=DEFAULT_BATCH_WINDOW,
+                 readers=DEFAULT_READERS):
+        self.tasks = LaneQueue()
+        self.read_tasks = LaneQueue()
+        self.batch_size = batch_size
+        self.batch_window = batch_window
         conn = self.open_connection()
         self.running = True
         self.stopped = False
 
-        # Run setup query, then close, so it can be opened in worker thread.
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS last_message (
-                guild_id    TEXT NOT NULL,
-                user_id     TEXT NOT NULL,
-                uname       TEXT NOT NULL,
-                timestamp   DATETIME NOT NULL,
-                PRIMARY KEY(guild_id, user_id)
-            );
-            
-            CREATE TABLE IF NOT EXISTS sync_progress (
-                guild_id    TEXT PRIMARY KEY NOT NULL,
-                timestamp   DATETIME NOT NULL,
-                synced      BOOLEAN NOT NULL
-            );
-        """)
-
-        conn.commit()
+        # Bring the schema up to date, then close, so it can be opened in worker thread.
+        # WAL mode is stored in the database file, so it only needs setting once.
+        self.migrate(conn)
+        conn.execute("PRAGMA journal_mode = WAL;")
         conn.close()
 
         self.thread = threading.Thread(target=self.run)
         self.thread.start()
 
+        self.reader_threads = [threading.Thread(target=self.run_reader) for _ in range(readers)]
+        for thread in self.reader_threads:
+            thread.start()
+
     def run(self):
         conn = self.open_connection()
         while self.running:
@@ -47,55 +358,253 @@ class Database:
             # This try except and timeout is to ensure thread can cleanly
             # stop when a KeyboardInterrupt is received.
             try:
-                func, args, result_queue = self.tasks.get(timeout=10)
+                task = self.tasks.get(timeout=10)
             except Empty:
                 continue
 
+            # Keep the thread alive whatever happens, or nothing queued would ever
+            # get a result
             try:
-                cursor = conn.cursor()
-                logger.debug(f"Running db function {func.__name__} with args {args}")
-                value, written = func(cursor, *args)
-                if written:
-                    conn.commit()
-                result_queue.put((True, value))
-            except Exception as e:
-                result_queue.put((False, e))
+                self.run_batch(conn, task)
+            except Exception:
+                logger.exception("Unexpected error in database writer thread.")
 
         conn.close()
         self.stopped = True
 
+    def run_reader(self):
+        conn = self.open_connection(read_only=True)
+        while self.running:
+            try:
+                func, args, future = self.read_tasks.get(timeout=10)
+            except Empty:
+                continue
+
+            try:
+                logger.debug(f"Running db read function {func.__name__} with args {args}")
+                value, _ = func(conn.cursor(), *args)
+                _hand_back(future, True, value)
+            except Exception as e:
+                _hand_back(future, False, e)
+
+        conn.close()
+
+    def run_batch(self, conn, first_task):
+        """
+        Runs the given task, along with any others that are queued up behind it, in a
+        single transaction. Results are only handed back to the callers once the
+        transaction has been committed, so a caller never sees a write that could still
+        be lost. A task that raises has all of its statements rolled back, so it adds
+        nothing to the commit. Every task taken off the queue gets a result, even if
+        the batch itself fails.
+        :param conn: The worker thread's sqlite3 connection
+        :param first_task: The task that was just taken off the queue
+        """
+        results = []
+        written = False
+        deadline = None
+        task = first_task
+
+        try:
+            # Take the write lock up front. If another process is sharing the database, a
+            # transaction that starts out reading can't wait for the lock once it wants to
+            # write - it just fails.
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Couldn't lock the database for a batch, running it anyway: {str(e)}")
+
+            while task is not None:
+                func, args, future = task
+                task = None
+                savepoint = False
+
+                try:
+                    # Each task gets a savepoint, so one that fails part way through
+                    # doesn't leave its earlier statements in the batch. A savepoint
+                    # outside a transaction would commit on release, so start one if
+                    # BEGIN IMMEDIATE failed.
+                    if not conn.in_transaction:
+                        conn.execute("BEGIN;")
+                    conn.execute("SAVEPOINT task;")
+                    savepoint = True
+
+                    cursor = conn.cursor()
+                    logger.debug(f"Running db function {func.__name__} with args {args}")
+                    value, task_written = func(cursor, *args)
+                    conn.execute("RELEASE task;")
+                except Exception as e:
+                    if not savepoint or not conn.in_transaction:
+                        # Some errors (SQLITE_FULL, IOERR, ...) make SQLite roll back the
+                        # whole transaction, taking the rest of the batch with it.
+                        results.append((future, False, e))
+                        raise
+
+                    conn.execute("ROLLBACK TO task;")
+                    conn.execute("RELEASE task;")
+                    results.append((future, False, e))
+                else:
+                    results.append((future, True, value))
+                    if task_written and not written:
+                        written = True
+                        deadline = time.monotonic() + self.batch_window
+
+                if len(results) >= self.batch_size:
+                    break
+
+                # Only wait around for more work if there is something to commit -
+                # reads are handed straight back.
+                try:
+                    if written:
+                        remaining = deadline - time.monotonic()
+                        task = self.tasks.get(timeout=remaining) if remaining > 0 else self.tasks.get_nowait()
+                    else:
+                        task = self.tasks.get_nowait()
+                except Empty:
+                    break
+
+            if written:
+                conn.commit()
+                logger.debug(f"Committed batch of {len(results)} tasks. Queued: {self.queue_depths()}")
+            elif conn.in_transaction:
+                conn.rollback()
+        except Exception as e:
+            logger.error(f"Failed to run batch of {len(results)} tasks: {str(e)}")
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                logger.exception("Failed to roll back batch.")
+
+            if task is not None:
+                results.append((task[2], False, e))
+            # Nothing in the batch was committed, so the tasks that had succeeded fail too
+            results = [(future, False, value if not ok else e) for future, ok, value in results]
+        finally:
+            for future, ok, value in results:
+                _hand_back(future, ok, value)
+
     @staticmethod
-    def open_connection():
+    def migrate(conn):
+        """
+        Applies any migrations the database hasn't had yet. Each migration runs in its
+        own transaction along with the user_version bump, so a failed migration leaves
+        the database at the previous version.
+
+        Several bot processes can share the database, and may start at the same time,
+        so the version is only read while holding the write lock.
+        :param conn: An open sqlite3 connection
+        """
+        while True:
+            conn.execute("BEGIN IMMEDIATE;")
+            version = conn.execute("PRAGMA user_version;").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return
+
+            number = version + 1
+            migration = MIGRATIONS[version]
+            logger.info(f"Migrating database to version {number}")
+            try:
+                if callable(migration):
+                    # These may need to run outside a transaction, so another process
+                    # can get to them first - they have to be safe to run twice.
+                    conn.rollback()
+                    migration(conn)
+
+                    conn.execute("BEGIN IMMEDIATE;")
+                    if conn.execute("PRAGMA user_version;").fetchone()[0] < number:
+                        conn.execute(f"PRAGMA user_version = {number};")
+                else:
+                    for statement in _split_statements(migration):
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number};")
+                conn.commit()
+            except Exception:
+                logger.error(f"Database migration {number} failed.")
+                conn.rollback()
+                raise
+
+    @staticmethod
+    def open_connection(read_only=False):
         conn = sqlite3.connect(
-            "activity.db",
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+            f"file:{DB_PATH}?mode=ro" if read_only else DB_PATH,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            timeout=BUSY_TIMEOUT,
+            uri=read_only
         )
         conn.row_factory = sqlite3.Row
+        conn.create_function("popcount", 1, _popcount, deterministic=True)
 
         return conn
 
-    def submit(self, func, *args):
-        result_queue = queue.Queue()
-        self.tasks.put((func, args, result_queue))
-        ok, value = result_queue.get()
-        if ok:
-            return value
-        else:
-            logger.error(f"Uncaught exception in database function.")
-            raise value
+    def submit(self, func, *args, read_only=False, lane=LANE_INTERACTIVE, ordered=False):
+        """
+        Queues a database function to run in the worker thread, or one of the reader
+        threads if read_only is set. Must be called from within a running event loop.
+        :return: An asyncio future which the worker thread resolves with the result
+        """
+        future = asyncio.get_running_loop().create_future()
+        (self.read_tasks if read_only else self.tasks).put((func, args, future), lane, ordered)
+        return future
+
+    def queue_depths(self):
+        """
+        :return: A dict of the number of queued writer and reader tasks in each lane
+        """
+        return {
+            "write": dict(zip(LANE_NAMES, self.tasks.depths())),
+            "read": dict(zip(LANE_NAMES, self.read_tasks.depths())),
+        }
 
     def close(self):
         self.running = False
 
+    def is_stopped(self):
+        return self.stopped and not any(thread.is_alive() for thread in self.reader_threads)
+
+def _hand_back(future, ok, value):
+    try:
+        future.get_loop().call_soon_threadsafe(_resolve_future, future, ok, value)
+    except RuntimeError:
+        # The event loop the caller was waiting on has already closed.
+        logger.debug("Dropping result for closed event loop.")
+
+def _resolve_future(future, ok, value):
+    # Runs on the caller's event loop. The caller may have been cancelled while
+    # waiting, in which case there's nobody left to hand the result to.
+    if future.done():
+        return
+
+    if ok:
+        future.set_result(value)
+    else:
+        logger.error(f"Uncaught exception in database function.")
+        future.set_exception(value)
+
 _database = Database()
 
+Gauge(
+    "adiosbot_db_queue_depth",
+    "Database tasks waiting to run, by queue and lane.",
+    ("queue", "lane"),
+    lambda: {
+        (queue, lane): depth
+        for queue, lanes in _database.queue_depths().items()
+        for lane, depth in lanes.items()
+    }
+)
+
 def db_close():
     _database.close()
 
 def is_db_stopped():
-    return _database.stopped
+    return _database.is_stopped()
+
+def db_queue_depths():
+    return _database.queue_depths()
 
-async def db_exec(func, *args):
+async def db_exec(func, *args, lane=LANE_INTERACTIVE, ordered=False):
     """
     Async wrapper for database connection. Submits a database function to run in
     the database thread, then returns the result
@@ -106,15 +615,34 @@ async def db_exec(func, *args):
         UPDATE, DELETE, etc.)
     :param args: All the arguments to pass into this function except for the sqlite3
         cursor.
+    :param lane: Priority lane to queue the function in - LANE_INTERACTIVE for
+        anything a user is waiting on, LANE_LIVE for live events and LANE_BACKFILL
+        for history sync and background jobs.
+    :param ordered: Don't let the function overtake anything queued before it in a
+        lower priority lane. Writes to the member roster, and member removals, need
+        this so they land in the order the events happened relative to history sync.
     :return: The first return value of the function (whatever is returned from the
         database.)
     """
-    loop = asyncio.get_running_loop()
     logger.debug("Submitting function...")
-    return await loop.run_in_executor(
-        None,
-        lambda: _database.submit(func, *args)
-    )
+    start = time.perf_counter()
+    try:
+        return await _database.submit(func, *args, lane=lane, ordered=ordered)
+    finally:
+        DB_LATENCY.observe(time.perf_counter() - start, function=func.__name__, mode="write")
+
+async def db_read(func, *args, lane=LANE_INTERACTIVE):
+    """
+    Like db_exec, but for functions that only read. These run on one of the read-only
+    connections, so they don't queue up behind writes. They see everything committed
+    by db_exec calls that have already returned.
+    """
+    logger.debug("Submitting read function...")
+    start = time.perf_counter()
+    try:
+        return await _database.submit(func, *args, read_only=True, lane=lane)
+    finally:
+        DB_LATENCY.observe(time.perf_counter() - start, function=func.__name__, mode="read")
 
 # Database functions - don't use these directly. Instead, pass these through
 # db_exec, which will pass the arguments along to the database connection in its
@@ -125,21 +653,74 @@ async def db_exec(func, *args):
 # All these functions have 2 return values - the first is the actual return
 # value from the database (or None). The second indicates if the function
 # wrote anything to the database, determining if there are changes to be
-# committed.
+# committed. Functions that only read can also be passed through db_read.
+
+# Timestamps are passed in and returned as integer milliseconds since the Unix
+# epoch - use to_epoch_ms and from_epoch_ms to convert.
 
 def add_timestamp(cursor:sqlite3.Cursor, guild_id, user_id, uname, timestamp):
-    add_timestamp_sql = """
-    INSERT INTO last_message(guild_id, user_id, uname, timestamp)
-    VALUES (?, ?, ?, ?)
+    return add_timestamps(cursor, [(guild_id, user_id, uname, timestamp, 1)])
+
+def add_timestamps(cursor: sqlite3.Cursor, rows):
+    """
+    Bulk version of add_timestamp. Keeps the newest timestamp for each user, and
+    merges in the days they were active on.
+    :param cursor: SQLite connection cursor
+    :param rows: Iterable of (guild_id, user_id, uname, timestamp_ms, day_bits) tuples,
+        with day_bits anchored at the day of timestamp_ms
+    """
+    add_timestamps_sql = f"""
+    INSERT INTO last_message(guild_id, user_id, uname, timestamp, day_bits)
+    VALUES (?, ?, ?, ?, ?)
     ON CONFLICT(guild_id, user_id)
     DO UPDATE SET
-        timestamp = excluded.timestamp
-    WHERE excluded.timestamp > last_message.timestamp;
+        timestamp = MAX(last_message.timestamp, excluded.timestamp),
+        day_bits = (
+            (last_message.day_bits << (MAX(last_message.timestamp, excluded.timestamp) / {DAY_MS} - last_message.timestamp / {DAY_MS}))
+            | (excluded.day_bits << (MAX(last_message.timestamp, excluded.timestamp) / {DAY_MS} - excluded.timestamp / {DAY_MS}))
+        ) & {DAY_BITS_MASK}
+    WHERE excluded.timestamp > last_message.timestamp
+        OR (excluded.day_bits << (last_message.timestamp / {DAY_MS} - excluded.timestamp / {DAY_MS}))
+            & ~last_message.day_bits & {DAY_BITS_MASK} != 0;
+    """
+
+    cursor.executemany(add_timestamps_sql, rows)
+    return None, True
+
+def add_history_page(cursor: sqlite3.Cursor, guild_id, channel_id, rows, message_id):
+    """
+    Writes one page of synced message history, and moves the channel's sync cursor
+    up to the last message in the page, in the same transaction.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param channel_id: ID of the channel the page came from
+    :param rows: Iterable of (guild_id, user_id, uname, timestamp_ms, day_bits) tuples
+    :param message_id: ID of the last message processed in the page
+    """
+    set_channel_cursor_sql = """
+    INSERT INTO channel_cursor(guild_id, channel_id, message_id)
+    VALUES (?, ?, ?)
+    ON CONFLICT(guild_id, channel_id)
+    DO UPDATE SET
+        message_id = excluded.message_id
+    WHERE excluded.message_id > channel_cursor.message_id;
     """
 
-    cursor.execute(add_timestamp_sql, (guild_id, user_id, uname, timestamp))
+    add_timestamps(cursor, rows)
+    cursor.execute(set_channel_cursor_sql, (guild_id, channel_id, message_id))
     return None, True
 
+def get_channel_cursors(cursor: sqlite3.Cursor, guild_id):
+    """
+    :return: A dict of channel ID to the ID of the last message synced in that channel
+    """
+    get_channel_cursors_sql = """
+    SELECT channel_id, message_id FROM channel_cursor WHERE guild_id = ?;
+    """
+
+    cursor.execute(get_channel_cursors_sql, (guild_id,))
+    return {int(row["channel_id"]): row["message_id"] for row in cursor.fetchall()}, False
+
 def add_sync_progress(cursor: sqlite3.Cursor, guild_id, timestamp):
     add_sync_progress_sql = """
     INSERT INTO sync_progress(guild_id, timestamp, synced)
@@ -157,14 +738,14 @@ def add_sync_progress(cursor: sqlite3.Cursor, guild_id, timestamp):
 def finish_sync(cursor: sqlite3.Cursor, guild_id):
     finish_sync_sql = """
     INSERT INTO sync_progress(guild_id, timestamp, synced)
-    VALUES (?, datetime('now'), TRUE)
+    VALUES (?, ?, TRUE)
     ON CONFLICT (guild_id)
     DO UPDATE SET
         synced = excluded.synced
     WHERE excluded.timestamp > sync_progress.timestamp;
     """
 
-    cursor.execute(finish_sync_sql, (guild_id,))
+    cursor.execute(finish_sync_sql, (guild_id, to_epoch_ms(datetime.now(timezone.utc))))
     return None, True
 
 def get_last_active_time(cursor: sqlite3.Cursor, guild_id, user_id):
@@ -188,9 +769,7 @@ def get_last_active_times(cursor: sqlite3.Cursor, guild_id):
 
 def get_last_stored_timestamp(cursor: sqlite3.Cursor, guild_id):
     get_last_stored_timestamp_sql = """
-    SELECT timestamp FROM last_message
-    WHERE guild_id = ?
-    ORDER BY timestamp DESC;
+    SELECT MAX(timestamp) FROM last_message WHERE guild_id = ?;
     """
 
     cursor.execute(get_last_stored_timestamp_sql, (guild_id,))
@@ -217,9 +796,7 @@ def get_limit(cursor: sqlite3.Cursor, guild_id):
     """
 
     get_last_stored_timestamp_sql = """
-    SELECT timestamp FROM last_message
-    WHERE guild_id = ?
-    ORDER BY timestamp DESC;
+    SELECT MAX(timestamp) FROM last_message WHERE guild_id = ?;
     """
 
     cursor.execute(get_sync_data_sql, (guild_id,))
@@ -243,4 +820,384 @@ def remove_user(cursor: sqlite3.Cursor, guild_id, user_id):
     """
 
     cursor.execute(remove_user_sql, (guild_id, user_id))
-    return None, True
\ No newline at end of file
+    return None, True
+
+def set_members(cursor: sqlite3.Cursor, guild_id, rows):
+    """
+    Replaces the stored member roster for a guild.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param rows: Iterable of (user_id, uname, bot) tuples
+    """
+    clear_members_sql = """
+    DELETE FROM members WHERE guild_id = ?;
+    """
+
+    add_members_sql = """
+    INSERT INTO members(guild_id, user_id, uname, bot)
+    VALUES (?, ?, ?, ?);
+    """
+
+    cursor.execute(clear_members_sql, (guild_id,))
+    cursor.executemany(add_members_sql, ((guild_id, user_id, uname, bot) for user_id, uname, bot in rows))
+    return None, True
+
+def has_members(cursor: sqlite3.Cursor, guild_id):
+    """
+    :return: True if a member roster is stored for the guild
+    """
+    has_members_sql = """
+    SELECT EXISTS(SELECT 1 FROM members WHERE guild_id = ?);
+    """
+
+    cursor.execute(has_members_sql, (guild_id,))
+    return bool(cursor.fetchone()[0]), False
+
+def add_member(cursor: sqlite3.Cursor, guild_id, user_id, uname, bot):
+    add_member_sql = """
+    INSERT INTO members(guild_id, user_id, uname, bot)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id)
+    DO UPDATE SET
+        uname = excluded.uname;
+    """
+
+    cursor.execute(add_member_sql, (guild_id, user_id, uname, bot))
+    return None, True
+
+def rename_user(cursor: sqlite3.Cursor, user_id, uname):
+    rename_user_sql = """
+    UPDATE members SET uname = ? WHERE user_id = ?;
+    """
+
+    cursor.execute(rename_user_sql, (uname, user_id))
+    return None, True
+
+def write_activity(cursor: sqlite3.Cursor, rows, removed):
+    """
+    Writes out buffered activity - new timestamps, then members who have left.
+    :param cursor: SQLite connection cursor
+    :param rows: Iterable of (guild_id, user_id, uname, timestamp_ms, day_bits) tuples
+    :param removed: Iterable of (guild_id, user_id) tuples for members who left
+    """
+    remove_members_sql = """
+    DELETE FROM members WHERE guild_id = ? AND user_id = ?;
+    """
+
+    remove_users_sql = """
+    DELETE FROM last_message WHERE guild_id = ? AND user_id = ?;
+    """
+
+    removed = list(removed)
+    add_timestamps(cursor, rows)
+    cursor.executemany(remove_members_sql, removed)
+    cursor.executemany(remove_users_sql, removed)
+    return None, True
+
+def remove_guild_data(cursor: sqlite3.Cursor, guild_id):
+    """
+    Deletes everything stored for a guild.
+    """
+    remove_kick_targets_sql = """
+    DELETE FROM kick_targets
+    WHERE job_id IN (SELECT job_id FROM kick_jobs WHERE guild_id = ?);
+    """
+
+    cursor.execute(remove_kick_targets_sql, (guild_id,))
+    for table in ("last_message", "sync_progress", "channel_cursor", "members", "kick_jobs", "whitelist"):
+        cursor.execute(f"DELETE FROM {table} WHERE guild_id = ?;", (guild_id,))
+    return None, True
+
+def purge_old_data(cursor: sqlite3.Cursor, guild_ids, cutoff, shard_ids=None, shard_count=None):
+    """
+    Deletes data for guilds the bot is no longer in, and message timestamps older
+    than the cutoff for the rest.
+    :param cursor: SQLite connection cursor
+    :param guild_ids: IDs of the guilds the bot is currently in
+    :param cutoff: Timestamp in milliseconds since the epoch
+    :param shard_ids: Shards guild_ids came from, if this process doesn't run them
+        all. Guilds on other shards are left alone, since another process sharing
+        the database is looking after them.
+    :param shard_count: Total number of shards, needed with shard_ids
+    :return: The number of stale guilds removed and the number of old timestamps removed
+    """
+    get_stored_guilds_sql = """
+    SELECT guild_id FROM sync_progress
+    UNION SELECT DISTINCT guild_id FROM last_message
+    UNION SELECT DISTINCT guild_id FROM members
+    UNION SELECT DISTINCT guild_id FROM whitelist;
+    """
+
+    purge_old_timestamps_sql = """
+    DELETE FROM last_message WHERE guild_id = ? AND timestamp < ?;
+    """
+
+    current = {str(guild_id) for guild_id in guild_ids}
+    cursor.execute(get_stored_guilds_sql)
+    stale = [
+        row[0] for row in cursor.fetchall()
+        if row[0] not in current and (shard_ids is None or (int(row[0]) >> 22) % shard_count in shard_ids)
+    ]
+    for guild_id in stale:
+        remove_guild_data(cursor, guild_id)
+
+    # One delete per guild, so each is a range scan over the guild/timestamp index
+    purged = 0
+    for guild_id in current:
+        cursor.execute(purge_old_timestamps_sql, (guild_id, cutoff))
+        purged += cursor.rowcount
+
+    return (len(stale), purged), True
+
+def incremental_vacuum(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA incremental_vacuum;")
+    cursor.fetchall()
+    return None, True
+
+def remove_members(cursor: sqlite3.Cursor, guild_id, user_ids):
+    """
+    Removes members from the roster, along with their message history.
+    """
+    remove_members_sql = """
+    DELETE FROM members WHERE guild_id = ? AND user_id = ?;
+    """
+
+    remove_users_sql = """
+    DELETE FROM last_message WHERE guild_id = ? AND user_id = ?;
+    """
+
+    rows = [(guild_id, user_id) for user_id in user_ids]
+    cursor.executemany(remove_members_sql, rows)
+    cursor.executemany(remove_users_sql, rows)
+    return None, True
+
+def get_member_activity(cursor: sqlite3.Cursor, guild_id):
+    """
+    :return: A list of (user_id, uname, timestamp) rows for every human member of the
+        guild, with timestamp None for members who have never sent a message.
+    """
+    get_member_activity_sql = """
+    SELECT m.user_id, m.uname, l.timestamp FROM members m
+    LEFT JOIN last_message l
+        ON l.guild_id = m.guild_id AND l.user_id = m.user_id
+    WHERE m.guild_id = ? AND NOT m.bot;
+    """
+
+    cursor.execute(get_member_activity_sql, (guild_id,))
+    return [tuple(row) for row in cursor.fetchall()], False
+
+def get_inactive_users(cursor: sqlite3.Cursor, guild_id, cutoff):
+    """
+    Finds the human members of a guild who haven't sent a message since the cutoff.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param cutoff: Timestamp in milliseconds since the epoch
+    :return: A list of rows with user_id and uname
+    """
+    get_inactive_users_sql = """
+    SELECT m.user_id, m.uname FROM members m
+    LEFT JOIN last_message l
+        ON l.guild_id = m.guild_id AND l.user_id = m.user_id
+    WHERE m.guild_id = ?
+        AND NOT m.bot
+        AND (l.timestamp IS NULL OR l.timestamp < ?);
+    """
+
+    cursor.execute(get_inactive_users_sql, (guild_id, cutoff))
+    return cursor.fetchall(), False
+
+def get_lurkers(cursor: sqlite3.Cursor, guild_id, today, days, min_active_days):
+    """
+    Finds the human members of a guild who sent messages on fewer than min_active_days
+    of the last few days.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param today: Day number (milliseconds since the epoch // DAY_MS) of the last day
+        to count
+    :param days: Number of days to count, up to ACTIVITY_DAYS
+    :param min_active_days: Members active on at least this many days aren't returned
+    :return: A list of rows with user_id, uname and active_days
+    """
+    # Shifting each bitmap so bit 0 is today lines them all up, and the mask then
+    # keeps just the days asked about.
+    get_lurkers_sql = f"""
+    SELECT user_id, uname, active_days FROM (
+        SELECT m.user_id, m.uname,
+            popcount((l.day_bits << (? - l.timestamp / {DAY_MS})) & ?) AS active_days
+        FROM members m
+        LEFT JOIN last_message l
+            ON l.guild_id = m.guild_id AND l.user_id = m.user_id
+        WHERE m.guild_id = ?
+            AND NOT m.bot
+    )
+    WHERE active_days < ?;
+    """
+
+    cursor.execute(get_lurkers_sql, (today, (1 << days) - 1, guild_id, min_active_days))
+    return cursor.fetchall(), False
+
+def get_daily_active(cursor: sqlite3.Cursor, guild_id, today, days):
+    """
+    Counts how many users sent messages in a guild on each of the last few days.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param today: Day number of the last day to count
+    :param days: Number of days to count, up to ACTIVITY_DAYS
+    :return: A list of counts, today's first
+    """
+    # Line the bitmaps up with bit 0 as today, as in get_lurkers, then count each day's
+    # bit across every row in a single pass.
+    day_counts = ", ".join(f"SUM((aligned >> {day}) & 1)" for day in range(days))
+    get_daily_active_sql = f"""
+    SELECT {day_counts} FROM (
+        SELECT (day_bits << (? - timestamp / {DAY_MS})) & ? AS aligned
+        FROM last_message
+        WHERE guild_id = ? AND timestamp >= ?
+    );
+    """
+
+    cursor.execute(get_daily_active_sql, (today, (1 << days) - 1, guild_id, (today - days + 1) * DAY_MS))
+    return [count or 0 for count in cursor.fetchone()], False
+
+def get_whitelist_ids(cursor: sqlite3.Cursor, guild_id):
+    """
+    :return: A set of the whitelisted user IDs in the guild
+    """
+    get_whitelist_ids_sql = """
+    SELECT user_id FROM whitelist WHERE guild_id = ?;
+    """
+
+    cursor.execute(get_whitelist_ids_sql, (guild_id,))
+    return {int(row["user_id"]) for row in cursor.fetchall()}, False
+
+def add_to_whitelist(cursor: sqlite3.Cursor, guild_id, user_ids):
+    add_to_whitelist_sql = """
+    INSERT OR IGNORE INTO whitelist(guild_id, user_id) VALUES (?, ?);
+    """
+
+    cursor.executemany(add_to_whitelist_sql, ((guild_id, user_id) for user_id in user_ids))
+    return None, True
+
+def remove_from_whitelist(cursor: sqlite3.Cursor, guild_id, user_id):
+    remove_from_whitelist_sql = """
+    DELETE FROM whitelist WHERE guild_id = ? AND user_id = ?;
+    """
+
+    cursor.execute(remove_from_whitelist_sql, (guild_id, user_id))
+    return None, True
+
+# Kick jobs. A job is 'running' until it is 'done', 'cancelled' or 'aborted'
+# (the bot was missing permissions). Each target is 'pending' until it is
+# 'kicked', 'failed', or 'gone' (left before it could be kicked).
+
+def create_kick_job(cursor: sqlite3.Cursor, guild_id, channel_id, days, created_at, targets):
+    """
+    Stores a new running kick job along with its targets, unless the guild already
+    has one running - checked in the same transaction, so two jobs can't both start.
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param channel_id: ID of the channel the job was started from
+    :param days: Inactivity threshold the targets were picked with
+    :param created_at: Timestamp in milliseconds since the epoch
+    :param targets: Iterable of (user_id, uname) tuples
+    :return: The ID of the new job, or None if another job is still running
+    """
+    get_running_job_sql = """
+    SELECT EXISTS(SELECT 1 FROM kick_jobs WHERE guild_id = ? AND status = 'running');
+    """
+
+    create_kick_job_sql = """
+    INSERT INTO kick_jobs(guild_id, channel_id, days, status, created_at)
+    VALUES (?, ?, ?, 'running', ?);
+    """
+
+    add_kick_targets_sql = """
+    INSERT INTO kick_targets(job_id, user_id, uname, status)
+    VALUES (?, ?, ?, 'pending');
+    """
+
+    cursor.execute(get_running_job_sql, (guild_id,))
+    if cursor.fetchone()[0]:
+        return None, False
+
+    cursor.execute(create_kick_job_sql, (guild_id, channel_id, days, created_at))
+    job_id = cursor.lastrowid
+    cursor.executemany(add_kick_targets_sql, ((job_id, user_id, uname) for user_id, uname in targets))
+    return job_id, True
+
+def get_kick_job(cursor: sqlite3.Cursor, guild_id, job_id=None):
+    """
+    :param cursor: SQLite connection cursor
+    :param guild_id: ID of the guild
+    :param job_id: ID of the job, or None for the guild's latest job
+    :return: The job's row, with a count of targets in each status, or None if there
+        is no such job in the guild.
+    """
+    get_kick_job_sql = """
+    SELECT * FROM kick_jobs
+    WHERE guild_id = ? AND (? IS NULL OR job_id = ?)
+    ORDER BY job_id DESC
+    LIMIT 1;
+    """
+
+    count_kick_targets_sql = """
+    SELECT status, COUNT(*) AS count FROM kick_targets
+    WHERE job_id = ?
+    GROUP BY status;
+    """
+
+    cursor.execute(get_kick_job_sql, (guild_id, job_id, job_id))
+    job = cursor.fetchone()
+    if job is None:
+        return None, False
+
+    cursor.execute(count_kick_targets_sql, (job["job_id"],))
+    counts = {row["status"]: row["count"] for row in cursor.fetchall()}
+    return (dict(job), counts), False
+
+def get_running_kick_jobs(cursor: sqlite3.Cursor, guild_id=None):
+    """
+    :return: Rows for every running kick job, optionally only in one guild.
+    """
+    get_running_kick_jobs_sql = """
+    SELECT * FROM kick_jobs
+    WHERE status = 'running' AND (? IS NULL OR guild_id = ?)
+    ORDER BY job_id;
+    """
+
+    cursor.execute(get_running_kick_jobs_sql, (guild_id, guild_id))
+    return cursor.fetchall(), False
+
+def get_pending_kick_targets(cursor: sqlite3.Cursor, job_id):
+    """
+    :return: A list of (user_id, uname) rows for targets that haven't been dealt with yet
+    """
+    get_pending_kick_targets_sql = """
+    SELECT user_id, uname FROM kick_targets
+    WHERE job_id = ? AND status = 'pending';
+    """
+
+    cursor.execute(get_pending_kick_targets_sql, (job_id,))
+    return cursor.fetchall(), False
+
+def set_kick_target_status(cursor: sqlite3.Cursor, job_id, user_ids, status):
+    set_kick_target_status_sql = """
+    UPDATE kick_targets SET status = ?
+    WHERE job_id = ? AND user_id = ?;
+    """
+
+    cursor.executemany(set_kick_target_status_sql, ((status, job_id, user_id) for user_id in user_ids))
+    return None, True
+
+def set_kick_job_status(cursor: sqlite3.Cursor, job_id, status):
+    """
+    Sets a running job's status. Jobs that have already finished are left alone.
+    :return: True if the job was running
+    """
+    set_kick_job_status_sql = """
+    UPDATE kick_jobs SET status = ?
+    WHERE job_id = ? AND status = 'running';
+    """
+
+    cursor.execute(set_kick_job_status_sql, (status, job_id))
+    return cursor.rowcount > 0, True
@@ -1,15 +1,22 @@
 # Load existing messages from disk
+import asyncio
 import json
 import logging
 import os
 from datetime import datetime, timezone, timedelta
-from time import perf_counter
+from time import perf_counter, monotonic
 
 import discord
 
-from utils.database import db_exec, add_timestamp, get_last_active_times, remove_user, \
-    get_limit, add_sync_progress, finish_sync
+from utils.activitycache import activity_cache
+from utils.activityindex import activity_index
+from utils.database import db_exec, db_read, add_history_page, get_last_active_time, get_limit, \
+    add_sync_progress, finish_sync, get_channel_cursors, to_epoch_ms, from_epoch_ms, get_inactive_users, \
+    set_members, purge_old_data, incremental_vacuum, get_member_activity, get_whitelist_ids, add_to_whitelist, \
+    remove_from_whitelist, has_members, get_last_active_times, merge_day_bits, get_lurkers, get_daily_active, \
+    DAY_MS, LANE_BACKFILL
 from utils.globals import WHITELIST_DIR
+from utils.metrics import MESSAGES_INGESTED, CHANNEL_SYNC_DURATION
 from utils.syncmanager import sync_manager
 
 logger = logging.getLogger(__name__)
@@ -17,78 +24,215 @@ logger.setLevel(logging.INFO)
 
 wl_dir = WHITELIST_DIR
 
-# Get the last message timestamp for each user
-async def get_last_message_time(guild):
-    last_active = await db_exec(
-        get_last_active_times,
-        guild.id
+# Number of messages discord.py fetches per channel.history request
+HISTORY_PAGE_SIZE = 100
+
+# In lazy member mode, /inactive downloads a guild's member list again once the
+# stored one is this many seconds old.
+MEMBER_REFRESH_INTERVAL = 60 * 60
+
+# guild_id -> monotonic time the guild's member list was last downloaded
+_members_fetched = {}
+
+# Shared by every guild sync in the process, whichever shard or event started it.
+# Created on first use, since GUILD_SYNC_CONCURRENCY is only known after setup().
+_guild_sync_semaphore = None
+
+# Message timestamps older than this many days are never needed, and how often
+# (in hours) the retention job clears them out.
+RETENTION_DAYS = 60
+RETENTION_INTERVAL = 6
+
+# Get the members of a guild who haven't sent a message since the cutoff (in
+# milliseconds since the epoch), as a list of (user_id, uname) tuples. The guild
+# owner is never included.
+async def get_inactive_members(guild, cutoff):
+    inactive = activity_index.inactive(guild.id, cutoff)
+    if inactive is not None:
+        return [(user_id, uname) for user_id, uname in inactive if user_id != guild.owner_id]
+
+    rows = await db_read(
+        get_inactive_users,
+        guild.id,
+        cutoff
     )
 
-    user_last_messages = {}
+    inactive = []
+    for row in rows:
+        user_id = int(row["user_id"])
+        if user_id == guild.owner_id or activity_cache.is_removed(guild.id, user_id):
+            continue
+
+        # The member may have sent a message that hasn't been written out yet
+        buffered = activity_cache.get(guild.id, user_id)
+        if buffered is not None and buffered >= cutoff:
+            continue
+
+        inactive.append((user_id, row["uname"]))
+
+    return inactive
 
-    for row in last_active:
-        user_id = row["user_id"]
-        if guild.get_member(int(user_id)) is not None:
-            user_last_messages[int(user_id)] = datetime.fromisoformat(
-                row["timestamp"]
-            )
-        else:
-            logger.debug(f"User {user_id} no longer guild member, deleting reference")
-            await db_exec(
-                remove_user,
-                guild.id,
-                user_id
-            )
 
-    return user_last_messages
+# Get the members of a guild who sent messages on fewer than min_active_days of
+# the last `days` days, as a list of (user_id, uname, active_days) tuples. The
+# guild owner is never included.
+async def get_lurking_members(guild, days, min_active_days):
+    # Day bits only live in the database, so write out anything buffered first
+    await activity_cache.flush()
+
+    today = to_epoch_ms(datetime.now(timezone.utc)) // DAY_MS
+    rows = await db_read(get_lurkers, guild.id, today, days, min_active_days)
+
+    return [
+        (int(row["user_id"]), row["uname"], row["active_days"])
+        for row in rows
+        if int(row["user_id"]) != guild.owner_id
+    ]
+
+
+# Get the number of users who sent messages in a guild on each of the last
+# `days` days, today's first
+async def get_daily_active_counts(guild, days):
+    await activity_cache.flush()
+
+    today = to_epoch_ms(datetime.now(timezone.utc)) // DAY_MS
+    return await db_read(get_daily_active, guild.id, today, days)
+
+
+# Get the last message timestamp for a single user, in milliseconds since the
+# epoch, or None if they haven't sent any. Members missing from the index (in lazy
+# member mode, those who joined while the bot was offline) are looked up directly.
+async def get_last_active(guild_id, user_id):
+    if activity_index.has_member(guild_id, user_id):
+        return activity_index.get(guild_id, user_id)
+
+    last_active_time = await db_read(
+        get_last_active_time,
+        guild_id,
+        user_id
+    )
+
+    buffered = activity_cache.get(guild_id, user_id)
+    if buffered is not None and (last_active_time is None or buffered > last_active_time):
+        last_active_time = buffered
 
+    return last_active_time
+
+
+# Fetch and save messages from a specific channel, only fetching new ones.
+# If the channel has a sync cursor, carry on from the last message synced there,
+# otherwise fall back to the earliest timestamp. Returns False if the channel was
+# skipped because nothing new has been posted.
+async def fetch_new_messages(channel, earliest, last_message_id=None):
+    # The gateway tells us the newest message in each channel, so if that's the
+    # one we last synced, there's no need to ask for history at all.
+    if (last_message_id is not None and channel.last_message_id is not None
+            and channel.last_message_id <= last_message_id):
+        logger.debug(f"No new messages in {channel.name}, skipping")
+        return False
 
-# Fetch and save messages from a specific channel, only fetching new ones
-async def fetch_new_messages(channel, earliest):
     logger.debug(f"Fetching messages from {channel.name}")
+
     current_utc_time = datetime.now(timezone.utc)
-    limit = current_utc_time - timedelta(days=60)
+    after = current_utc_time - timedelta(days=60)
 
     # Go back a maximum of 60 days in history per channel
-    if earliest is not None and earliest > limit:
-        limit = earliest
+    if last_message_id is not None and discord.utils.snowflake_time(last_message_id) > after:
+        after = discord.Object(id=last_message_id)
+    elif earliest is not None and earliest > after:
+        after = earliest
+
+    # Reduce each page of history to the newest message and the days active per
+    # author, and write the page out in one go along with the channel's new cursor.
+    latest = {}
+    count = 0
+    last_msg = None
+
+    async for msg in channel.history(limit=None, oldest_first=True, after=after):
+        count += 1
+        last_msg = msg
+
+        if not msg.author.bot:
+            MESSAGES_INGESTED.inc(source="sync")
+            entry = latest.get(msg.author.id)
+            created_at = to_epoch_ms(msg.created_at)
+            if entry is None:
+                latest[msg.author.id] = (msg.author.name, created_at, 1)
+            else:
+                latest[msg.author.id] = (msg.author.name, *merge_day_bits(entry[1], entry[2], created_at, 1))
+
+        if count % HISTORY_PAGE_SIZE == 0:
+            await write_history_page(channel, latest, last_msg.id)
+            latest = {}
+
+    if last_msg is not None and count % HISTORY_PAGE_SIZE != 0:
+        await write_history_page(channel, latest, last_msg.id)
+
+    return True
 
-    async for msg in channel.history(limit=None, oldest_first=True, after=limit):
-        if msg.author.bot:
-            continue
 
-        await db_exec(
-            add_timestamp,
-            msg.guild.id,
-            msg.author.id,
-            msg.author.name,
-            msg.created_at
-        )
+async def write_history_page(channel, latest, message_id):
+    guild_id = channel.guild.id
+    await db_exec(
+        add_history_page,
+        guild_id,
+        channel.id,
+        [(guild_id, user_id, uname, timestamp, day_bits) for user_id, (uname, timestamp, day_bits) in latest.items()],
+        message_id,
+        lane=LANE_BACKFILL
+    )
+
+    for user_id, (uname, timestamp, _) in latest.items():
+        activity_index.update(guild_id, user_id, timestamp)
 
 
 # Fetch and save messages from all channels
 async def fetch_messages(guild):
-    timestamp_str = await db_exec(
+    timestamp = await db_read(
         get_limit,
-        guild.id
+        guild.id,
+        lane=LANE_BACKFILL
     )
-    timestamp = datetime.fromisoformat(timestamp_str) \
-        if timestamp_str is not None else None
 
-    limit = datetime.now(timezone.utc) - timedelta(days=60)
+    limit = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=60))
     if timestamp is not None and timestamp > limit:
         limit = timestamp
 
+    await db_exec(add_sync_progress, guild.id, limit, lane=LANE_BACKFILL)
+
+    limit = from_epoch_ms(limit)
     logger.debug(f"Beginning timestamp bound in {guild.name}: {limit}")
 
-    await db_exec(add_sync_progress, guild.id, limit)
+    cursors = await db_read(get_channel_cursors, guild.id, lane=LANE_BACKFILL)
+
+    from utils.globals import SYNC_CONCURRENCY
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    # discord.py keeps a rate limit bucket per route (so per channel for history
+    # requests) and waits on it before each request, so crawling several channels
+    # at once only ever waits on the channels that are actually limited.
+    async def fetch_channel(channel):
+        async with semaphore:
+            channel_start = perf_counter()
+            fetched = await fetch_new_messages(channel, limit, cursors.get(channel.id))
+            channel_end = perf_counter()
+            if fetched:
+                CHANNEL_SYNC_DURATION.observe(channel_end - channel_start)
+                logger.info(f"Fetched #{channel.name} in {guild.name} in {channel_end - channel_start:.2f}s")
+            return fetched
 
     start = perf_counter()
-    for channel in guild.text_channels:
-        if channel.permissions_for(guild.me).read_message_history:
-            await fetch_new_messages(channel, limit)
+    results = await asyncio.gather(*(
+        fetch_channel(channel)
+        for channel in guild.text_channels
+        if channel.permissions_for(guild.me).read_message_history
+    ))
 
-    await db_exec(finish_sync, guild.id)
+    skipped = results.count(False)
+    if skipped:
+        logger.info(f"Skipped {skipped} unchanged channels in {guild.name}")
+
+    await db_exec(finish_sync, guild.id, lane=LANE_BACKFILL)
 
     end = perf_counter()
 
@@ -96,27 +240,185 @@ async def fetch_messages(guild):
     sync_manager.set_ready(guild.id)
 
 
-def get_whitelist(guild: discord.Guild):
-    global wl_dir
-    if wl_dir is None:
-        from utils.globals import WHITELIST_DIR
-        wl_dir = WHITELIST_DIR
+# Store the full member list of a guild, replacing whatever was stored before.
+# In lazy member mode, members aren't downloaded at startup, so the list stored
+# by the last run is used instead if there is one - refresh_members brings it up
+# to date before it's relied on.
+async def seed_members(guild):
+    from utils.globals import LAZY_MEMBERS
+    if LAZY_MEMBERS and not guild.chunked:
+        if await db_read(has_members, guild.id, lane=LANE_BACKFILL):
+            return
 
-    guild_wl_path = os.path.join(wl_dir, f"{guild.id}.json")
-
-    if os.path.exists(guild_wl_path):
-        with open(guild_wl_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        # Download without filling discord.py's member cache
+        members = await guild.chunk(cache=False)
+        _members_fetched[guild.id] = monotonic()
     else:
-        return []
+        if not guild.chunked:
+            await guild.chunk()
+        members = guild.members
+
+    await db_exec(
+        set_members,
+        guild.id,
+        [(member.id, member.name, member.bot) for member in members],
+        lane=LANE_BACKFILL,
+        ordered=True
+    )
+
+
+# Download a guild's member list in lazy member mode, if the stored one is older
+# than max_age seconds, and update the stored list and activity index to match.
+# Returns a dict of user ID to Member for the downloaded members, or None if the
+# list wasn't downloaded - in which case guild.get_member is up to date.
+async def refresh_members(guild, max_age=MEMBER_REFRESH_INTERVAL):
+    from utils.globals import LAZY_MEMBERS
+    if not LAZY_MEMBERS or guild.chunked:
+        return None
+
+    fetched = _members_fetched.get(guild.id)
+    if fetched is not None and monotonic() - fetched < max_age:
+        return None
+
+    start = perf_counter()
+    members = await guild.chunk(cache=False)
+    _members_fetched[guild.id] = monotonic()
+
+    await db_exec(set_members, guild.id, [(member.id, member.name, member.bot) for member in members], ordered=True)
+
+    # Members who joined while the bot was offline may already have messages stored
+    stored = {int(row["user_id"]): row["timestamp"] for row in await db_read(get_last_active_times, guild.id)}
+    buffered = activity_cache.get_guild(guild.id)
+    activity_index.set_members(guild.id, [
+        (member.id, member.name, max(stored.get(member.id) or 0, buffered.get(member.id) or 0) or None)
+        for member in members
+        if not member.bot
+    ])
+
+    end = perf_counter()
+    logger.info(f"Downloaded {len(members)} members of {guild.name} in {end - start:.2f}s")
+
+    return {member.id: member for member in members}
+
+
+# Delete data for guilds the bot has left and timestamps outside the retention
+# window, then give the freed space back to the filesystem. When this process only
+# runs some of the shards, only those shards' guilds are checked.
+async def run_retention(guild_ids, shard_ids=None, shard_count=None):
+    cutoff = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS))
+
+    start = perf_counter()
+    stale_guilds, purged = await db_exec(
+        purge_old_data, guild_ids, cutoff, shard_ids, shard_count, lane=LANE_BACKFILL
+    )
+    await db_exec(incremental_vacuum, lane=LANE_BACKFILL)
+    end = perf_counter()
+
+    logger.info(f"Retention complete - removed {stale_guilds} stale guilds and {purged} old timestamps "
+                f"in {end - start:.2f}s")
 
-def set_whitelist(guild: discord.Guild, whitelist):
+
+# Load a guild's stored activity into the in-memory index
+async def load_activity(guild):
+    rows = await db_read(get_member_activity, guild.id, lane=LANE_BACKFILL)
+    activity_index.load(guild.id, rows)
+
+    # Messages that haven't been written out yet
+    for user_id, timestamp in activity_cache.get_guild(guild.id).items():
+        activity_index.update(guild.id, user_id, timestamp)
+
+
+def _get_guild_sync_semaphore():
+    global _guild_sync_semaphore
+    if _guild_sync_semaphore is None:
+        from utils.globals import GUILD_SYNC_CONCURRENCY
+        _guild_sync_semaphore = asyncio.Semaphore(GUILD_SYNC_CONCURRENCY)
+    return _guild_sync_semaphore
+
+
+# Sync a single guild, holding that guild's sync lock. At most
+# GUILD_SYNC_CONCURRENCY guilds sync at once across the whole process.
+async def sync_guild(guild):
+    async with _get_guild_sync_semaphore(), sync_manager.lock(guild.id):
+        sync_manager.start_syncing(guild.id)
+        try:
+            await seed_members(guild)
+            await load_activity(guild)
+            await fetch_messages(guild)
+        finally:
+            sync_manager.finish_syncing(guild.id)
+
+
+# Sync several guilds at once. Smaller guilds go first, since they finish
+# sooner and can start taking commands while the larger ones are still going.
+async def sync_guilds(guilds):
+    sync_manager.add_guilds(guilds)
+
+    # Tasks start in creation order, and the semaphore wakes waiters in the order
+    # they arrived, so sorting here decides who gets it first.
+    ordered = sorted(guilds, key=lambda g: g.member_count or 0)
+    await asyncio.gather(*(sync_guild(guild) for guild in ordered))
+
+
+# Whitelists are cached per guild as sets, and dropped from the cache whenever
+# they change. Each change also bumps the guild's generation, so a read that was
+# already under way when the whitelist changed doesn't cache what it read.
+_whitelists = {}
+_whitelist_generations = {}
+
+async def get_whitelist(guild: discord.Guild):
+    """
+    :return: The set of whitelisted user IDs for the guild. Don't modify it - use
+        add_whitelist_member and remove_whitelist_member instead.
+    """
+    whitelist = _whitelists.get(guild.id)
+    if whitelist is None:
+        generation = _whitelist_generations.get(guild.id, 0)
+        whitelist = await db_read(get_whitelist_ids, guild.id)
+        if _whitelist_generations.get(guild.id, 0) == generation:
+            _whitelists[guild.id] = whitelist
+
+    return whitelist
+
+def forget_whitelist(guild_id):
+    """
+    Drops a guild's cached whitelist, after it has changed or been deleted.
+    """
+    _whitelist_generations[guild_id] = _whitelist_generations.get(guild_id, 0) + 1
+    _whitelists.pop(guild_id, None)
+
+async def add_whitelist_member(guild: discord.Guild, user_id):
+    await db_exec(add_to_whitelist, guild.id, (user_id,))
+    forget_whitelist(guild.id)
+
+async def remove_whitelist_member(guild: discord.Guild, user_id):
+    await db_exec(remove_from_whitelist, guild.id, user_id)
+    forget_whitelist(guild.id)
+
+async def import_whitelist_files():
+    """
+    Moves whitelists from the old per-guild JSON files into the database. Each file
+    is renamed once imported so it's only ever imported once.
+    """
     global wl_dir
     if wl_dir is None:
         from utils.globals import WHITELIST_DIR
         wl_dir = WHITELIST_DIR
 
-    guild_wl_path = os.path.join(wl_dir, f"{guild.id}.json")
+    for filename in os.listdir(wl_dir):
+        guild_id, ext = os.path.splitext(filename)
+        if ext != ".json" or not guild_id.isdigit():
+            continue
 
-    with open(guild_wl_path, 'w', encoding='utf-8') as f:
-        json.dump(whitelist, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+        guild_wl_path = os.path.join(wl_dir, filename)
+        try:
+            with open(guild_wl_path, 'r', encoding='utf-8') as f:
+                whitelist = json.load(f)
+
+            await db_exec(add_to_whitelist, int(guild_id), whitelist, lane=LANE_BACKFILL)
+            forget_whitelist(int(guild_id))
+            os.replace(guild_wl_path, f"{guild_wl_path}.imported")
+        except FileNotFoundError:
+            # Another shard process sharing the working directory got to it first
+            continue
+        logger.info(f"Imported {len(whitelist)} whitelisted members for guild {guild_id}")
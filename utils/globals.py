@@ -6,10 +6,57 @@ from dotenv import load_dotenv
 # Make these names available elsewhere
 working_dir: str | None = None
 WHITELIST_DIR: str | None = None
+SYNC_CONCURRENCY: int = 4
+GUILD_SYNC_CONCURRENCY: int = 2
+KICK_CONCURRENCY: int = 4
+METRICS_PORT: int | None = None
+SHARD_COUNT: int | None = None
+SHARD_IDS: list[int] | None = None
+LAZY_MEMBERS: bool = False
+
+
+def _get_int_env(logger, name, default, minimum=1):
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    try:
+        return max(minimum, int(value))
+    except ValueError:
+        logger.warning(f"{name} is not a number, defaulting to {default}.")
+        return default
+
+
+def _get_bool_env(name, default=False):
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _get_shard_ids_env(logger, name):
+    """
+    Reads a list of shard IDs like "0-3,8", or None if the variable isn't set.
+    """
+    value = os.getenv(name)
+    if not value:
+        return None
+
+    shard_ids = set()
+    try:
+        for part in value.split(","):
+            first, _, last = part.strip().partition("-")
+            shard_ids.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        logger.error(f"Error: {name} should be a list of shard IDs and ranges, like 0-3,8")
+        exit(1)
+
+    return sorted(shard_ids)
 
 
 def setup() -> str:
-    global working_dir, WHITELIST_DIR
+    global working_dir, WHITELIST_DIR, SYNC_CONCURRENCY, GUILD_SYNC_CONCURRENCY, KICK_CONCURRENCY, METRICS_PORT, \
+        SHARD_COUNT, SHARD_IDS, LAZY_MEMBERS
 
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
@@ -37,6 +84,23 @@ def setup() -> str:
     if not os.path.exists(WHITELIST_DIR):
         os.makedirs(WHITELIST_DIR)
 
+    SYNC_CONCURRENCY = _get_int_env(logger, 'SYNC_CONCURRENCY', SYNC_CONCURRENCY)
+    GUILD_SYNC_CONCURRENCY = _get_int_env(logger, 'GUILD_SYNC_CONCURRENCY', GUILD_SYNC_CONCURRENCY)
+    KICK_CONCURRENCY = _get_int_env(logger, 'KICK_CONCURRENCY', KICK_CONCURRENCY)
+    METRICS_PORT = _get_int_env(logger, 'METRICS_PORT', METRICS_PORT)
+
+    SHARD_COUNT = _get_int_env(logger, 'SHARD_COUNT', SHARD_COUNT)
+    SHARD_IDS = _get_shard_ids_env(logger, 'SHARD_IDS')
+    if SHARD_IDS is not None:
+        if SHARD_COUNT is None:
+            logger.error("Error: SHARD_IDS is set, but SHARD_COUNT isn't")
+            exit(1)
+        if SHARD_IDS[-1] >= SHARD_COUNT:
+            logger.error(f"Error: SHARD_IDS must all be less than SHARD_COUNT ({SHARD_COUNT})")
+            exit(1)
+
+    LAZY_MEMBERS = _get_bool_env('LAZY_MEMBERS', LAZY_MEMBERS)
+
     logger.debug(WHITELIST_DIR)
     logger.debug(working_dir)
 
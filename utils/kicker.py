@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from time import monotonic
+
+import discord
+
+from utils.metrics import KICKS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 5
+
+
+class KickExecutor:
+    """
+    Kicks a list of members, with one worker per kick allowed in flight. discord.py already waits on the
+    kick route's rate limit bucket, going by the bucket headers Discord sends back,
+    and sleeps through any 429s itself - so the concurrency here only needs to be
+    enough to keep that bucket busy.
+
+    Kicking stops as soon as the bot turns out to be missing permissions.
+    """
+    def __init__(self, guild, reason, concurrency, on_progress=None, on_kicked=None):
+        """
+        :param guild: Guild to kick members from
+        :param reason: Reason shown in the audit log
+        :param concurrency: Maximum number of kicks in flight at once
+        :param on_progress: Optional coroutine function taking (done, total), called at
+            most every PROGRESS_INTERVAL seconds while kicking
+        :param on_kicked: Optional coroutine function taking the member, called as soon
+            as each kick has gone through
+        """
+        self.guild = guild
+        self.reason = reason
+        self.concurrency = concurrency
+        self.on_progress = on_progress
+        self.on_kicked = on_kicked
+
+        self.kicked = []
+        self.failed = []
+        self.missing_perms = False
+        self.stopped = False
+
+        self._done = 0
+        self._total = 0
+        self._last_progress = 0.0
+
+    async def run(self, members):
+        """
+        Kicks all the given members.
+        :return: The list of members that were kicked
+        """
+        pending = asyncio.Queue()
+        for member in members:
+            pending.put_nowait(member)
+        self._total = pending.qsize()
+        self._last_progress = monotonic()
+
+        workers = [asyncio.create_task(self._worker(pending)) for _ in range(self.concurrency)]
+        await asyncio.gather(*workers)
+
+        return self.kicked
+
+    def stop(self):
+        """
+        Stops kicking once the kicks already in flight have finished.
+        """
+        self.stopped = True
+
+    async def _worker(self, pending):
+        while not (self.missing_perms or self.stopped):
+            try:
+                member = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                await member.kick(reason=self.reason)
+            except discord.Forbidden:
+                logger.error(f"Missing permissions to kick {member.name}.")
+                self.missing_perms = True
+                return
+            except Exception as e:
+                logger.error(f'Error kicking {member.name}: {str(e)}')
+                self.failed.append(member)
+                KICKS.inc(result="failed")
+            else:
+                self.kicked.append(member)
+                KICKS.inc(result="kicked")
+                logger.info(f"Kicked {member.name} in {self.guild.name} for inactivity.")
+                if self.on_kicked is not None:
+                    await self.on_kicked(member)
+
+            self._done += 1
+            await self._report_progress()
+
+    async def _report_progress(self):
+        if self.on_progress is None or monotonic() - self._last_progress < PROGRESS_INTERVAL:
+            return
+
+        self._last_progress = monotonic()
+        try:
+            await self.on_progress(self._done, self._total)
+        except discord.HTTPException as e:
+            # Most likely the interaction token has expired - kicking carries on regardless
+            logger.debug(f"Couldn't update kick progress: {str(e)}")
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from utils.database import db_exec, to_epoch_ms, create_kick_job, get_running_kick_jobs, \
+    get_pending_kick_targets, set_kick_target_status, set_kick_job_status, remove_members
+from utils.functions import refresh_members, get_whitelist
+from utils.kicker import KickExecutor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class KickJobs:
+    """
+    Runs kick jobs. A job's targets are stored when it's created, and each target's
+    outcome is written back as kicking goes on, so a job interrupted by a restart
+    picks up where it left off instead of recomputing who to kick. Kicks are recorded
+    one by one as they go through, so a restart never mistakes a kicked member for one
+    who left.
+    """
+    def __init__(self):
+        # job_id -> KickExecutor for jobs running in this process
+        self._executors = {}
+
+    def is_running(self, job_id):
+        return job_id in self._executors
+
+    async def create(self, guild, channel_id, days, members):
+        """
+        Stores a new job for the given members.
+        :return: The ID of the new job, or None if the guild already has one running
+        """
+        return await db_exec(
+            create_kick_job,
+            guild.id,
+            channel_id,
+            days,
+            to_epoch_ms(datetime.now(timezone.utc)),
+            [(member.id, member.name) for member in members]
+        )
+
+    async def run(self, job_id, guild, days, members, concurrency, on_progress=None):
+        """
+        Kicks the given members as part of a job, recording each outcome.
+        :param job_id: ID of the job
+        :param guild: Guild to kick members from
+        :param days: Inactivity threshold of the job, for the audit log reason
+        :param members: Members still to be kicked
+        :param concurrency: Maximum number of kicks in flight at once
+        :param on_progress: Optional coroutine function taking (done, total)
+        :return: The KickExecutor used, holding the kicked and failed members
+        """
+        recorded = {"kicked": 0, "failed": 0}
+
+        async def record_kick(member):
+            try:
+                await db_exec(set_kick_target_status, job_id, [member.id], "kicked")
+            except Exception as e:
+                # The next checkpoint records it again
+                logger.error(f"Couldn't record kick of {member.name} in job {job_id}: {str(e)}")
+
+        async def checkpoint():
+            kicked = executor.kicked[recorded["kicked"]:]
+            failed = executor.failed[recorded["failed"]:]
+            recorded["kicked"] += len(kicked)
+            recorded["failed"] += len(failed)
+
+            # Each kick's status is already written by record_kick, this makes sure
+            # of it and clears the kicked members out of the roster in one go
+            if kicked:
+                kicked_ids = [member.id for member in kicked]
+                await db_exec(set_kick_target_status, job_id, kicked_ids, "kicked")
+                await db_exec(remove_members, guild.id, kicked_ids)
+            if failed:
+                await db_exec(set_kick_target_status, job_id, [member.id for member in failed], "failed")
+
+        async def progress(done, total):
+            await checkpoint()
+            if on_progress is not None:
+                await on_progress(done, total)
+
+        executor = KickExecutor(
+            guild,
+            f"Inactive in {guild.name} for {days} days",
+            concurrency,
+            on_progress=progress,
+            on_kicked=record_kick
+        )
+
+        self._executors[job_id] = executor
+        try:
+            await executor.run(members)
+        finally:
+            del self._executors[job_id]
+            await checkpoint()
+
+        if executor.missing_perms:
+            status = "aborted"
+        elif executor.stopped:
+            status = "cancelled"
+        else:
+            status = "done"
+        await db_exec(set_kick_job_status, job_id, status)
+        logger.info(f"Kick job {job_id} in {guild.name} finished - {status}")
+
+        return executor
+
+    async def cancel(self, job_id):
+        """
+        Cancels a running job.
+        :return: True if the job was still running
+        """
+        cancelled = await db_exec(set_kick_job_status, job_id, "cancelled")
+
+        executor = self._executors.get(job_id)
+        if executor is not None:
+            executor.stop()
+
+        return cancelled
+
+    async def resume(self, bot, concurrency):
+        """
+        Carries on with any jobs left running by a previous run of the bot, in guilds
+        this bot can see.
+        """
+        resumed = []
+        for job in await db_exec(get_running_kick_jobs):
+            job_id = job["job_id"]
+            guild = bot.get_guild(int(job["guild_id"]))
+            if guild is None or self.is_running(job_id):
+                continue
+
+            current = await refresh_members(guild, max_age=0)
+
+            # Members may have been whitelisted since the job was created, including
+            # while the bot was down
+            whitelist = await get_whitelist(guild)
+
+            members = []
+            gone = []
+            spared = []
+            for row in await db_exec(get_pending_kick_targets, job_id):
+                user_id = int(row["user_id"])
+                member = current.get(user_id) if current is not None else guild.get_member(user_id)
+                if user_id in whitelist:
+                    spared.append(row["user_id"])
+                elif member is not None:
+                    members.append(member)
+                else:
+                    gone.append(row["user_id"])
+
+            # Members who left are done with
+            if gone:
+                await db_exec(set_kick_target_status, job_id, gone, "gone")
+            if spared:
+                await db_exec(set_kick_target_status, job_id, spared, "whitelisted")
+
+            logger.info(f"Resuming kick job {job_id} in {guild.name} with {len(members)} members left")
+            resumed.append(self._run_resumed(bot, job, guild, members, concurrency))
+
+        await asyncio.gather(*resumed)
+
+    async def _run_resumed(self, bot, job, guild, members, concurrency):
+        executor = await self.run(job["job_id"], guild, job["days"], members, concurrency)
+
+        # The interaction that started the job is long gone, so report back in
+        # the channel it was started from instead.
+        channel = bot.get_channel(int(job["channel_id"])) if job["channel_id"] is not None else None
+        if channel is None:
+            return
+
+        try:
+            await channel.send(
+                f"Resumed kick job #{job['job_id']} finished - kicked {len(executor.kicked)} more members "
+                f"inactive for {job['days']} days."
+            )
+        except Exception as e:
+            logger.error(f"Couldn't report resumed kick job {job['job_id']}: {str(e)}")
+
+
+kick_jobs = KickJobs()
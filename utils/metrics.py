@@ -0,0 +1,187 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_started = time.monotonic()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        """
+        :return: The sum of all values matching the given labels
+        """
+        return sum(
+            value for key, value in self.values.items()
+            if all(key[self.labels.index(label)] == wanted for label, wanted in labels.items())
+        )
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    A gauge whose values are read from a callback when rendered. The callback returns a
+    dict of label value tuples to numbers.
+    """
+    def __init__(self, name, description, labels, callback):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.callback = callback
+        _metrics.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+
+        # label values -> [per-bucket counts, sum, count]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def quantile(self, q, key):
+        """
+        Estimates a quantile from the bucket counts.
+        :return: The upper bound of the bucket the quantile falls in, or None if
+            nothing has been observed.
+        """
+        entry = self.values.get(key)
+        if entry is None or entry[2] == 0:
+            return None
+
+        target = q * entry[2]
+        seen = 0
+        for bound, count in zip(self.buckets, entry[0]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def uptime():
+    return time.monotonic() - _started
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves the metrics at http://host:port/metrics.
+    :return: The aiohttp runner, to be cleaned up on shutdown
+    """
+    # aiohttp comes with discord.py, but only the bot itself needs it
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+DB_LATENCY = Histogram(
+    "adiosbot_db_latency_seconds",
+    "Time from submitting a database function to getting its result.",
+    labels=("function", "mode")
+)
+
+MESSAGES_INGESTED = Counter(
+    "adiosbot_messages_ingested_total",
+    "Messages whose timestamps were recorded.",
+    labels=("source",)
+)
+
+CHANNEL_SYNC_DURATION = Histogram(
+    "adiosbot_channel_sync_seconds",
+    "Time taken to sync the history of one channel.",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+)
+
+KICKS = Counter(
+    "adiosbot_kicks_total",
+    "Members /kick_inactive tried to kick, by outcome.",
+    labels=("result",)
+)
@@ -8,15 +8,24 @@ logger.setLevel(logging.INFO)
 class SyncManager:
     def __init__(self):
         self._ready = {}
-        self._syncing = True
+        self._locks = {}
+        self._syncing = set()
 
-        self.lock = asyncio.Lock()
+        # shard_id -> True once the shard's guilds have synced
+        self._shards = {}
 
     def add_guilds(self, guilds):
-        self._syncing = True
         for guild in guilds:
             self._ready[guild.id] = False
 
+    def lock(self, guild_id):
+        """
+        :return: The lock guarding message syncs for the given guild.
+        """
+        if guild_id not in self._locks:
+            self._locks[guild_id] = asyncio.Lock()
+        return self._locks[guild_id]
+
     def is_ready(self, guild_id):
         return self._ready.get(guild_id, False)
 
@@ -24,13 +33,32 @@ class SyncManager:
         logger.debug(f"{guild_id} is ready for commands.")
         self._ready[guild_id] = True
 
-    def is_syncing(self):
-        return self._syncing
+    def is_syncing(self, guild_id=None):
+        if guild_id is None:
+            return len(self._syncing) > 0
+        return guild_id in self._syncing
+
+    def start_syncing(self, guild_id):
+        self._syncing.add(guild_id)
+
+    def finish_syncing(self, guild_id):
+        self._syncing.discard(guild_id)
+
+    def start_shard(self, shard_id):
+        self._shards[shard_id] = False
+
+    def finish_shard(self, shard_id):
+        self._shards[shard_id] = True
 
-    def finish_syncing(self):
-        self._syncing = False
+    def shard_states(self):
+        """
+        :return: A dict of shard ID to whether that shard's guilds have finished syncing
+        """
+        return dict(self._shards)
 
     def remove_guild(self, guild_id):
-        self._ready.pop(guild_id)
+        self._ready.pop(guild_id, None)
+        self._locks.pop(guild_id, None)
+        self._syncing.discard(guild_id)
 
-sync_manager = SyncManager()
\ No newline at end of file
+sync_manager = SyncManager()